@@ -80,7 +80,8 @@ def add_common_args(parser):
     # somehow I named it "batches" instead of batch_size at first
     # "batches" is kept for now for backward compatibility
     parser.add_argument('--batch-size', '--batches', type=int, required=True,
-            help='mini-batch size, per GPU in training or in total in testing')
+            help='mini-batch size, per GPU in training or per process in '
+            'testing')
     parser.add_argument('--loader-workers', default=8, type=int,
             help='number of subprocesses per data loader. '
             '0 to disable multiprocessing')
@@ -93,6 +94,12 @@ def add_common_args(parser):
     parser.add_argument('--misc-kwargs', default='{}', type=json.loads,
             help='miscellaneous keyword arguments for custom models and '
             'norms. Be careful with name collisions')
+    parser.add_argument('--conv-tune', type=str,
+            help='path to the JSON cache of the styled convolution '
+            'autotuner, timing the grouped or dense method, the memory '
+            'format, and the cuDNN benchmark per layer signature once '
+            'across runs, leaving the global cuDNN benchmark off for the '
+            'other layers. Disabled if not set')
 
 
 def add_train_args(parser):
@@ -128,12 +135,38 @@ def add_train_args(parser):
             help='discriminator model, disabled by default')
     parser.add_argument('--adv-model-spectral-norm', action='store_true',
             help='enable spectral normalization on the discriminator')
+    parser.add_argument('--adv-spectral-norm-interval', default=1, type=int,
+            help='refresh the spectral norm power iteration at the first '
+            'discriminator forward of every this many steps, reusing it in '
+            'the other forwards')
     parser.add_argument('--adv-criterion', default='WDistLoss', type=str,
             help='adversarial loss function')
     parser.add_argument('--adv-wgan-gp-interval', default=1, type=int,
             help='interval (batches) between WGAN gradient penalty. '
             'Disabled if non-positive; '
             'lazy regularization if greater than 1 (not every batch)')
+    parser.add_argument('--adv-gp', default='wgan', type=str,
+            choices=['wgan', 'r1', 'r2'],
+            help='gradient penalty, WGAN on interpolates of fake and real '
+            'samples, or R1 (R2) on real (fake) samples, the latter reusing '
+            'the discriminator forward if on the whole batch')
+    parser.add_argument('--adv-gp-gamma', default=10, type=float,
+            help='weight of the gradient penalty')
+    parser.add_argument('--adv-gp-fraction', default=1, type=float,
+            help='fraction of the batch (at least 1 sample) to compute the '
+            'gradient penalty on, randomly sampled')
+    parser.add_argument('--adv-gp-patch-size', type=int,
+            help='size of a random spatial patch of the discriminator inputs '
+            'to compute the gradient penalty on, the whole by default')
+    parser.add_argument('--adv-single-pass', action='store_true',
+            help='evaluate the discriminator on the fake and real samples, '
+            'and the WGAN gradient penalty interpolates if of the same shape, '
+            'concatenated in one batch, with one backward. '
+            'Note that it changes the batch statistics of batchnorm layers')
+    parser.add_argument('--adv-reuse-fake', action='store_true',
+            help='reuse the fake scores of the discriminator step for the '
+            'generator adversarial loss, i.e. with the discriminator before '
+            'instead of after its update, saving a discriminator forward')
     parser.add_argument('--cgan', action='store_true',
             help='enable conditional GAN')
     parser.add_argument('--adv-start', default=0, type=int,
@@ -159,6 +192,9 @@ def add_train_args(parser):
             help='initial adversary learning rate, default to --lr')
     parser.add_argument('--adv-optimizer-args', type=json.loads,
             help='adversary optimizer arguments, default to --optimizer-args')
+    parser.add_argument('--zero-optimizer', action='store_true',
+            help='shard the (adversary) optimizer states across GPUs, '
+            'ZeRO stage 1. Checkpoints are consolidated and remain compatible')
     parser.add_argument('--reduce-lr-on-plateau', action='store_true',
             help='Enable ReduceLROnPlateau learning rate scheduler')
     parser.add_argument('--scheduler-args', default='{"verbose": true}',
@@ -171,6 +207,9 @@ def add_train_args(parser):
     parser.add_argument('--seed', default=3407, type=int,
             help='seed for initializing training')
 
+    parser.add_argument('--sample-files', default=5, type=int,
+            help='number of snapshots randomly sampled for training and '
+            'validation, e.g. to fit them in memory. 0 to use all')
     parser.add_argument('--div-data', action='store_true',
             help='enable data division among GPUs for better page caching. '
             'Data division is shuffled every epoch. '
@@ -185,10 +224,76 @@ def add_train_args(parser):
             'Change this to balance cache locality and stochasticity')
     parser.add_argument('--dist-backend', default='nccl', type=str,
             choices=['gloo', 'nccl'], help='distributed backend')
+    parser.add_argument('--rendezvous', default='auto', type=str,
+            choices=['auto', 'env', 'tcp', 'local', 'file'],
+            help='how processes find each other. '
+            '"env" for torchrun (elastic restarts from the latest checkpoint), '
+            '"tcp" for a TCPStore on the first slurm node (or MASTER_ADDR '
+            'and MASTER_PORT), '
+            '"local" for a single node without slurm, on CPUs with gloo if '
+            'no GPU is found, and '
+            '"file" for the deprecated dist_addr file in the working dir. '
+            '"auto" picks env, tcp, or local, in that order')
+    parser.add_argument('--dist-timeout', default=1800, type=float,
+            help='timeout in seconds for rendezvous and collectives')
+    parser.add_argument('--dist-retries', default=5, type=int,
+            help='number of retries to connect to the TCPStore')
+    parser.add_argument('--device', default='auto', type=str,
+            choices=['auto', 'cuda', 'cpu'],
+            help='train on GPUs (one process each), or CPUs with gloo. '
+            '"auto" uses GPUs if found')
+    parser.add_argument('--procs-per-node', '--local-procs', default=1,
+            type=int, help='number of processes per node on CPUs, '
+            'each gets an equal share of the CPUs')
+    parser.add_argument('--num-threads', type=int,
+            help='number of intra-op threads per process on CPUs. '
+            'Default is its share of CPUs minus --loader-workers')
+    parser.add_argument('--channels-last', action='store_true',
+            help='use channels_last_3d memory format for models and inputs, '
+            'usually faster for convolutions on CPUs')
+    parser.add_argument('--ddp-bucket-cap-mb', default=25, type=float,
+            help='DDP gradient bucket size in MiB. Smaller buckets start '
+            'allreduce earlier and overlap more with the backward pass')
+    parser.add_argument('--adv-ddp-bucket-cap-mb', type=float,
+            help='adversary DDP gradient bucket size in MiB, '
+            'default to --ddp-bucket-cap-mb')
+    parser.add_argument('--ddp-grad-as-bucket-view', action='store_true',
+            help='let gradients be views into the DDP buckets, saving a copy '
+            'and the gradient memory')
+    parser.add_argument('--ddp-static-graph', action='store_true',
+            help='enable DDP static graph mode for the (generator) model, '
+            'skipping the search for unused parameters')
+    parser.add_argument('--ddp-comm-hook', default='none', type=str,
+            choices=['none', 'fp16', 'bf16'],
+            help='compress gradients for the allreduce')
+    parser.add_argument('--adv-ddp-comm-hook', type=str,
+            choices=['none', 'fp16', 'bf16'],
+            help='compress adversary gradients for the allreduce, '
+            'default to --ddp-comm-hook')
+    parser.add_argument('--bench-spectral-norm', action='store_true',
+            help='benchmark the spectral norm overhead of the discriminator '
+            'steps on the first batch, for a few refresh intervals, and exit')
+    parser.add_argument('--bench-ddp', action='store_true',
+            help='benchmark the allreduce overlap for the DDP communication '
+            'configs on the first batch, and exit')
+    parser.add_argument('--bench-ddp-bucket-caps', default='5,25,100',
+            type=float_tuple,
+            help='comma-sep. list of bucket sizes in MiB to benchmark')
     parser.add_argument('--log-interval', default=100, type=int,
             help='interval (batches) between logging training loss')
+    parser.add_argument('--metrics', default='tensorboard', type=str,
+            help='comma-sep. list of metrics backends among tensorboard, '
+            'jsonl, csv, and http (latest values served on localhost)')
+    parser.add_argument('--metrics-flush-secs', default=10, type=float,
+            help='interval (seconds) between batched metrics writes '
+            'by the background thread')
+    parser.add_argument('--metrics-http-port', default=0, type=int,
+            help='port of the http metrics backend, 0 to pick a free one')
     parser.add_argument('--detect-anomaly', action='store_true',
             help='enable anomaly detection for the autograd engine')
+    parser.add_argument('--debug-copies', action='store_true',
+            help='count the tensor copies of every training step, '
+            'including those hidden inside ops, and log them')
 
 
 def add_test_args(parser):
@@ -201,9 +306,79 @@ def add_test_args(parser):
     parser.add_argument('--test-style-pattern', type=str,
             help='glob pattern for test data styles')
 
+    parser.add_argument('--device', default='auto', type=str,
+            choices=['auto', 'cuda', 'cpu'],
+            help='run on GPUs (one process each), or CPUs. '
+            '"auto" uses GPUs if found')
+    parser.add_argument('--procs-per-node', '--local-procs', default=1,
+            type=int, help='number of processes per node on CPUs, '
+            'each gets an equal share of the CPUs')
     parser.add_argument('--num-threads', type=int,
-            help='number of CPU threads when cuda is unavailable. '
-            'Default is the number of CPUs on the node by slurm')
+            help='number of intra-op threads per process on CPUs. '
+            'Default is its share of CPUs minus --loader-workers')
+    parser.add_argument('--shard-by', default='files', type=str,
+            choices=['files', 'crops'],
+            help='split the inference among processes by whole snapshots, '
+            'or by crops of every snapshot written into shared fields, '
+            'e.g. with fewer snapshots than processes')
+    parser.add_argument('--seed', default=3407, type=int,
+            help='seed for the noise, offset by the sample index of every '
+            'batch')
+    parser.add_argument('--noise-drawn', action='store_true',
+            help='draw the noise of the generator from the RNG seeded by '
+            '--seed offset by the first sample of every batch, which depends '
+            'on the batching. By default the noise of the models taking '
+            'the origin of the inputs is hashed from the global voxel '
+            'positions and --seed offset by the snapshot index, independent '
+            'of the tiling, sharding, batching, and resuming')
+    parser.add_argument('--cpu-workers', default=1, type=int,
+            help='number of threads per process on CPUs to run the patches '
+            'of a batch concurrently, splitting the intra-op threads')
+    parser.add_argument('--bench-cpu-workers', action='store_true',
+            help='benchmark on the first batch all splits of the intra-op '
+            'threads into --cpu-workers, and use the fastest')
+    parser.add_argument('--channels-last', action='store_true',
+            help='use channels_last_3d memory format for inputs on CPUs, '
+            'usually faster for oneDNN convolutions')
+    parser.add_argument('--bf16', action='store_true',
+            help='autocast to bfloat16 on CPUs')
+    parser.add_argument('--queue', type=str,
+            help='path to a JSON manifest of a work queue of snapshots, shared '
+            'by concurrent test jobs through a file lock, which record the '
+            'output checksums, skip the snapshots done, and retry the failed. '
+            'Overrides --shard-by, and implies --resume')
+    parser.add_argument('--queue-tries', default=3, type=int,
+            help='maximum number of tries of a snapshot in the queue')
+    parser.add_argument('--queue-timeout', type=float,
+            help='seconds after which a snapshot claimed by a job on another '
+            'host is reclaimed. Those of dead jobs on the same host are '
+            'always reclaimed')
+    parser.add_argument('--queue-verify', action='store_true',
+            help='check the outputs of the snapshots done in the queue '
+            'against their checksums, and redo those missing or modified')
+    parser.add_argument('--report', type=str,
+            help='path to write a CSV table of per-snapshot metrics, '
+            'accumulated on device: MSE per channel and power spectrum '
+            'ratios per field. Suffixed by the rank with multiple processes, '
+            'whose rows are partial with --shard-by crops, or by the host '
+            'and pid with --queue')
+    parser.add_argument('--report-eul', action='store_true',
+            help='also report the Eulerian density statistics from the '
+            'first 3 channels as displacements, by lag2eul')
+    parser.add_argument('--freeze-style', action='store_true',
+            help='precompute the modulated weights of the styled '
+            'convolutions once per style, for batches of a single style')
+    parser.add_argument('--trace-frozen', action='store_true',
+            help='trace the models with frozen styles by torch.jit, '
+            'with the origins and seeds of the anchored noise as inputs')
+    parser.add_argument('--resume', action='store_true',
+            help='skip the fields already assembled and continue the '
+            'partially written ones, after an interruption')
+    parser.add_argument('--tile-mem', type=float,
+            help='memory budget in GiB to plan the crop, pad, and step, '
+            'overriding those given, to tile the fields with the least '
+            'redundant halo compute, with the narrowing of the model '
+            'introspected on the meta device')
 
 
 def str_list(s):
@@ -219,6 +394,10 @@ def int_tuple(s):
         return t
 
 
+def float_tuple(s):
+    return tuple(float(i) for i in s.split(','))
+
+
 def set_common_args(args):
     pass
 
@@ -237,6 +416,11 @@ def set_train_args(args):
         if args.adv_optimizer_args is None:
             args.adv_optimizer_args = args.optimizer_args
 
+    if args.adv_ddp_bucket_cap_mb is None:
+        args.adv_ddp_bucket_cap_mb = args.ddp_bucket_cap_mb
+    if args.adv_ddp_comm_hook is None:
+        args.adv_ddp_comm_hook = args.ddp_comm_hook
+
     if args.cgan and not args.adv:
         args.cgan =False
         warnings.warn('Disabling cgan given adversary is disabled',
@@ -21,6 +21,8 @@ class FieldDataset(Dataset):
     Each pattern in the list is a new field.
     Likewise `tgt_patterns` is for target fields.
     Input and target fields are matched by sorting the globbed files.
+    With `sample_files`, only that many snapshots are randomly sampled from
+    them, e.g. to fit them in memory, otherwise all are used.
 
     `in_norms` is a list of of functions to normalize the input fields.
     Likewise for `tgt_norms`.
@@ -41,6 +43,10 @@ class FieldDataset(Dataset):
     The crop anchors are controlled by `crop_start`, `crop_stop`, and `crop_step`.
     Input (but not target) fields can be padded beyond the crop size assuming
     periodic boundary condition.
+    The global position of the first padded input voxel, i.e. the crop anchor
+    less the pad, is returned as `anchor`, e.g. for the noise hashed from the
+    global positions (see `models.noise`).
+    It ignores the flips and permutations of the augmentation.
 
     Setting integer `scale_factor` greater than 1 will crop target bigger than
     the input for super-resolution, in which case `crop` and `pad` are sizes of
@@ -50,30 +56,27 @@ class FieldDataset(Dataset):
                  in_norms=None, tgt_norms=None, callback_at=None,
                  augment=False, aug_shift=None, aug_add=None, aug_mul=None,
                  crop=None, crop_start=None, crop_stop=None, crop_step=None,
-                 in_pad=0, tgt_pad=0, scale_factor=1,
+                 in_pad=0, tgt_pad=0, scale_factor=1, sample_files=None,
                  **kwargs):
-        #you can adjust the random seed to randomize the in pattern sequence
-        sampling = True
         in_file_lists = [sorted(glob(p)) for p in in_patterns]
+        tgt_file_lists = [sorted(glob(p)) for p in tgt_patterns]
 
-        num_snapshots = len(in_file_lists[0])
+        # randomly subsample the snapshots, e.g. to fit them in memory
         #Bayu, 24/01/16. 3.6Gb per file. 15 files each for the displacement and velocity field gives 108Gb total. Frontera GPU node RAM: 128GB (2133 MT/s) DDR4
-        sample_idx = list(WeightedRandomSampler(weights=torch.ones(num_snapshots), num_samples= min(5, num_snapshots), replacement=False))
-        #sample_idx = list(WeightedRandomSampler(weights=torch.ones(num_snapshots), num_samples= min(64, num_snapshots), replacement=False))
-
-        if sampling:
-            sampled_in_list = [[x[i] for i in sample_idx] for x in in_file_lists]
-            self.in_files = list(zip(* sampled_in_list))
-        else:
-            self.in_files = list(zip(*in_file_lists))
+        num_snapshots = len(in_file_lists[0])
+        sample_idx = None
+        if sample_files is not None and sample_files < num_snapshots:
+            sample_idx = list(WeightedRandomSampler(
+                weights=torch.ones(num_snapshots), num_samples=sample_files,
+                replacement=False))
 
-        tgt_file_lists = [sorted(glob(p)) for p in tgt_patterns]
+        def sample(files):
+            if sample_idx is None:
+                return files
+            return [files[i] for i in sample_idx]
 
-        if sampling:
-            sampled_tgt_list = [[x[i] for i in sample_idx] for x in tgt_file_lists]
-            self.tgt_files = list(zip(* sampled_tgt_list))
-        else:
-            self.tgt_files = list(zip(*tgt_file_lists))
+        self.in_files = list(zip(*[sample(x) for x in in_file_lists]))
+        self.tgt_files = list(zip(*[sample(x) for x in tgt_file_lists]))
 
         if len(self.in_files) != len(self.tgt_files):
             raise ValueError('number of input and target fields do not match')
@@ -95,12 +98,7 @@ class FieldDataset(Dataset):
         self.style = style_pattern is not None
         self.style_size = 0
         if self.style:
-            style_files = sorted(glob(style_pattern))
-            if sampling:
-                sampled_style_list = [style_files[i] for i in sample_idx]
-                self.style_files = sampled_style_list
-            else:
-                self.style_files = style_files
+            self.style_files = sample(sorted(glob(style_pattern)))
 
             if len(self.style_files) != len(self.in_files):
                 raise ValueError('number of style and input files do not match')
@@ -173,14 +171,19 @@ class FieldDataset(Dataset):
 
         self.kwargs = kwargs
 
-        self.assembly_line = {}
-
         self.commonpath = os.path.commonpath(
             file
             for files in self.in_files[:2] + self.tgt_files[:2]
             for file in files
         )
 
+        self.assembly_line = {}
+        self.assembly_resume = False
+        self.assembly_ifile = {
+            os.path.relpath(files[0], start=self.commonpath): ifile
+            for ifile, files in enumerate(self.tgt_files)}
+        self.shard(0, 1)
+
     def __len__(self):
         return self.nsample
 
@@ -266,10 +269,13 @@ class FieldDataset(Dataset):
         tgt_relpath = [os.path.relpath(file, start=self.commonpath)
                        for file in self.tgt_files[ifile]]
 
+        anchor = torch.from_numpy(anchor - self.in_pad[:, 0]).long()
+
         return {
             'input': in_fields,
             'target': tgt_fields,
             'style': style,
+            'anchor': anchor,
             #'input_relpath': in_relpath,
             'target_relpath': tgt_relpath,
         }
@@ -279,25 +285,39 @@ class FieldDataset(Dataset):
         result from a cropped field by `__getitem__`.
 
         Repeat feeding spatially ordered field patches.
-        After filled, the whole fields are assembled and saved to relative
-        paths specified by `paths` and `label`.
+        The whole fields are opened as writable memmaps at the first patch,
+        and each patch is written into place as soon as it arrives, to
+        relative paths specified by `paths` and `label`.
+        So the memory footprint does not scale with the field size.
         `chan` is used to split the channels to undo `cat` in `__getitem__`.
 
         As an example, patches of shape `(1, 4, X, Y, Z)`, `label='_out'`
         and `chan=[1, 3]`, with `paths=[['d/scalar.npy'], ['d/vector.npy']]`
         will write to `'d/scalar_out.npy'` and `'d/vector_out.npy'`.
 
+        For super-resolution the fields are of the target resolution, i.e.
+        `scale_factor` times the input size, and so are the crop anchors.
+
+        The number of patches written is flushed in order together with the
+        fields to a progress file (see `progress_path`), which is removed
+        once the fields are complete.
+        If `self.assembly_resume` is set, partially written fields are opened
+        to continue from their progress, in which case the patches fed should
+        also start from there, see `assembled_crops`.
+
+        With multiple processes (see `shard`), each feeds and writes only its
+        own crops into the shared fields, with its own progress file.
+        A completion marker (see `done_path`) is left by the last process
+        finishing a field.
+
         Note that `paths` assumes transposed shape due to pytorch auto batching
         """
-        if self.scale_factor != 1:
-            raise NotImplementedError
-
         if isinstance(patches, torch.Tensor):
             patches = patches.detach().cpu().numpy()
 
         if patches.ndim != 2 + self.ndim:
             raise RuntimeError(f'ndim mismatch: {patches.ndim, 2 + self.ndim}')
-        if any(self.crop_step > patches.shape[2:]):
+        if any(self.crop_step * self.scale_factor > patches.shape[2:]):
             raise RuntimeError('patch too small to tile')
 
         # the batched paths are a list of lists with shape (channel, batch)
@@ -314,40 +334,248 @@ class FieldDataset(Dataset):
             raise RuntimeError('batch size mismatch: '
                                f'{patches.shape[0], len(paths)}')
 
-        patches = list(patches)
-        if label in self.assembly_line:
-            self.assembly_line[label] += patches
-            self.assembly_line[label + 'path'] += paths
+        # NOTE anchor positioning assumes sufficient target padding and
+        # symmetric narrowing (more on the right if odd) see `models/narrow.py`
+        # for super-resolution, the output is centered on the input crop,
+        # e.g. with `next_size = 2 * prev_size - 6` of `styled_srsgan.HBlock`
+        crop = self.crop * self.scale_factor
+        narrow = crop + self.tgt_pad.sum(axis=1) - patches.shape[2:]
+        anchors = (self.anchors * self.scale_factor
+                   - self.tgt_pad[:, 0] + narrow // 2)
+
+        line = self.assembly_line.setdefault(label, {})
+
+        for patch, path in zip(patches, paths):
+            if 'fields' not in line:
+                line['ifile'] = self.assembly_ifile[path[0]]
+                path = [label.join(os.path.splitext(p)) for p in path]
+                line['icrop'] = self._open_fields(line, path, chan,
+                                                  patch.dtype)
+
+            for field, start, stop in zip(line['fields'],
+                                          np.cumsum([0] + chan[:-1]),
+                                          np.cumsum(chan)):
+                fill(field, patch[start:stop], anchors[line['icrop']])
+
+            line['icrop'] += 1
+
+            if line['icrop'] == self.shard_crops[line['ifile']][1]:
+                self._flush_fields(line)
+                self._finish_fields(line)
+
+                del line['fields'], line['paths']
+
+        if 'fields' in line:
+            self._flush_fields(line)
+
+    def shard(self, rank, world_size, by='files', label='_out'):
+        """Split the samples among `world_size` processes for inference, by
+        whole `'files'` (round robin), or by contiguous `'crops'` of every
+        file, and set those of `rank` to be assembled.
+
+        Return the sample indices of `rank`, excluding the crops already
+        assembled with `label` if `self.assembly_resume` is set.
+        """
+        if by == 'files':
+            return self.select(range(rank, self.nfile, world_size),
+                               label=label)
+        elif by == 'crops':
+            bounds = np.linspace(0, self.ncrop, num=world_size + 1)
+            bounds = bounds.round().astype(int)
+            self.shard_bounds = bounds
+            self.shard_crops = {ifile: (bounds[rank], bounds[rank + 1])
+                                for ifile in range(self.nfile)}
+            self.shard_rank, self.shard_size = rank, world_size
         else:
-            self.assembly_line[label] = patches
-            self.assembly_line[label + 'path'] = paths
+            raise ValueError('sharding by {} not supported'.format(by))
 
-        del patches, paths
-        patches = self.assembly_line[label]
-        paths = self.assembly_line[label + 'path']
+        return self._shard_indices(label)
 
-        # NOTE anchor positioning assumes sufficient target padding and
-        # symmetric narrowing (more on the right if odd) see `models/narrow.py`
-        narrow = self.crop + self.tgt_pad.sum(axis=1) - patches[0].shape[1:]
-        anchors = self.anchors - self.tgt_pad[:, 0] + narrow // 2
+    def select(self, ifiles, label='_out'):
+        """Set whole files `ifiles` to be assembled, e.g. claimed from a work
+        queue, and return their sample indices like `shard`.
+        """
+        self.shard_crops = {ifile: (0, self.ncrop) for ifile in ifiles}
+        self.shard_rank, self.shard_size = 0, 1
+
+        return self._shard_indices(label)
+
+    def _shard_indices(self, label):
+        indices = []
+        for ifile, (start, stop) in self.shard_crops.items():
+            if self.assembly_resume:
+                start = self.assembled_crops(label, ifile)
+            indices.extend(ifile * self.ncrop + icrop
+                           for icrop in range(start, stop))
+        return indices
+
+    def _open_fields(self, line, paths, chan, dtype):
+        """Open output fields as memmaps, return the index of the next crop
+        to write.
+
+        The fields shared by multiple processes are created atomically by
+        whichever comes first, and opened by the others.
+        """
+        size = self.size * self.scale_factor
+        shape = [(int(c),) + tuple(int(s) for s in size) for c in chan]
+
+        start, stop = self.shard_crops[line['ifile']]
+        progress = self._progress_path(paths[0])
+
+        icrop = start
+        if self.assembly_resume:
+            icrop = max(read_progress(progress), start)
+
+        if icrop > start:
+            fields = [np.load(p, mmap_mode='r+') for p in paths]
+            if any(f.shape != s for f, s in zip(fields, shape)):
+                raise RuntimeError('cannot resume from {} of shapes {}'.format(
+                    paths, [f.shape for f in fields]))
+        else:
+            for p in paths:
+                pathlib.Path(os.path.dirname(p)).mkdir(parents=True,
+                                                       exist_ok=True)
+            write_progress(progress, start)
+            remove(done_path(paths[0]))
+
+            if self.shard_size == 1:
+                fields = [np.lib.format.open_memmap(p, mode='w+', dtype=dtype,
+                                                    shape=s)
+                          for p, s in zip(paths, shape)]
+            else:
+                fields = [open_shared_memmap(p, dtype, s)
+                          for p, s in zip(paths, shape)]
+
+        line['fields'] = fields
+        line['paths'] = paths
+
+        return icrop
+
+    def _flush_fields(self, line):
+        for field in line['fields']:
+            field.flush()
+        write_progress(self._progress_path(line['paths'][0]), line['icrop'])
+
+    def _finish_fields(self, line):
+        """Mark the fields complete if all processes have finished theirs.
+        """
+        path = line['paths'][0]
+
+        if self.shard_size > 1:
+            # ranks of empty shards never open the fields
+            bounds = self.shard_bounds
+            if any(read_progress(progress_path(path, rank, self.shard_size))
+                   < stop for rank, (start, stop)
+                   in enumerate(zip(bounds[:-1], bounds[1:]))
+                   if start < stop):
+                return
+
+        write_progress(done_path(path), self.ncrop)
+        for rank in range(self.shard_size):
+            remove(self._progress_path(path, rank))
+
+    def _progress_path(self, path, rank=None):
+        if rank is None:
+            rank = self.shard_rank
+        return progress_path(path, rank, self.shard_size)
+
+    def assembly_paths(self, label, ifile):
+        """Paths of the `ifile`-th fields assembled with `label`.
+        """
+        return [label.join(os.path.splitext(
+                    os.path.relpath(f, start=self.commonpath)))
+                for f in self.tgt_files[ifile]]
+
+    def reset_assembly(self, label, ifile):
+        """Forget the progress of the `ifile`-th fields assembled with `label`,
+        to assemble them again from scratch.
+        """
+        path = self.assembly_paths(label, ifile)[0]
+        remove(done_path(path))
+        for rank in range(self.shard_size):
+            remove(self._progress_path(path, rank))
+
+    def assembled_crops(self, label, ifile):
+        """Index of the next crop of the `ifile`-th fields to be assembled
+        with `label` by this process, the end of its crops if complete.
+        """
+        paths = self.assembly_paths(label, ifile)
+
+        start, stop = self.shard_crops.get(ifile, (0, self.ncrop))
+
+        if os.path.isfile(done_path(paths[0])):
+            return stop
+        else:
+            return max(read_progress(self._progress_path(paths[0])), start)
 
-        while len(patches) >= self.ncrop:
-            fields = np.zeros(patches[0].shape[:1] + tuple(self.size),
-                              patches[0].dtype)
 
-            for patch, anchor in zip(patches, anchors):
-                fill(fields, patch, anchor)
+def progress_path(path, rank=0, world_size=1):
+    """Progress file of a field, one per process if shared.
+    """
+    if world_size == 1:
+        return path + '.progress'
+    return path + '.progress{}of{}'.format(rank, world_size)
+
 
-            for field, path in zip(
-                    np.split(fields, np.cumsum(chan), axis=0),
-                    paths[0]):
-                pathlib.Path(os.path.dirname(path)).mkdir(parents=True,
-                                                          exist_ok=True)
+def done_path(path):
+    """Completion marker of a field.
+    """
+    return path + '.done'
 
-                path = label.join(os.path.splitext(path))
-                np.save(path, field)
 
-            del patches[:self.ncrop], paths[:self.ncrop]
+def read_progress(path):
+    """Index of the next crop to write to a field being assembled, 0 if not
+    started. `path` is a progress file.
+    """
+    try:
+        with open(path, 'r') as f:
+            return int(f.read())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def write_progress(path, icrop):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(str(icrop))
+    os.replace(tmp_path, path)
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def open_shared_memmap(path, dtype, shape):
+    """Create a `.npy` memmap atomically by hard linking a private temporary
+    file, or open it if already created by another process.
+    """
+    if os.path.isfile(path):
+        return open_memmap(path, dtype, shape)
+
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    field = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype,
+                                      shape=shape)
+    try:
+        os.link(tmp_path, path)
+    except FileExistsError:
+        del field
+        field = open_memmap(path, dtype, shape)
+    finally:
+        os.remove(tmp_path)
+
+    return field
+
+
+def open_memmap(path, dtype, shape):
+    field = np.load(path, mmap_mode='r+')
+    if field.shape != shape or field.dtype != dtype:
+        raise RuntimeError('{} of shape {} and dtype {} exists, expecting '
+                           '{} and {}'.format(path, field.shape, field.dtype,
+                                              shape, dtype))
+    return field
 
 
 def fill(field, patch, anchor):
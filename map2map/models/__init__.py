@@ -2,15 +2,19 @@ from .unet import UNet
 from .vnet import VNet
 from .patchgan import PatchGAN, PatchGAN42
 
-from .narrow import narrow_by, narrow_cast, narrow_like
-from .resample import resample, Resampler
+from .narrow import narrow_by, narrow_cast, narrow_like, CropPool, CopyCounter
+from .shape import shape_info
+from .autotune import ConvTuner, set_conv_tuner
+from .noise import hash_noise
+from .resample import resample, Resampler, upsample2
 
-from .lag2eul import lag2eul
+from .lag2eul import lag2eul, Lag2Eul
 from .power import power
 
 from .dice import DiceLoss, dice_loss
 
 from .wasserstein import WDistLoss, wasserstein_distance_loss, wgan_grad_penalty
-from .adversary import grad_penalty_reg
-from .spectral_norm import add_spectral_norm, rm_spectral_norm
+from .adversary import grad_penalty_reg, GradPenalty
+from .spectral_norm import (add_spectral_norm, rm_spectral_norm,
+                            bench_spectral_norm, format_spectral_norm)
 from .instance_noise import InstanceNoise
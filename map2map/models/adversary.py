@@ -1,3 +1,4 @@
+import time
 import torch
 
 
@@ -25,6 +26,165 @@ def grad_penalty_reg(output, input, gamma=10):
     return penalty
 
 
+class GradPenalty:
+    """Gradient penalty of the discriminator on the same interface for
+    `kind` 'wgan' (on interpolates of the fake and real samples, see
+    `wgan_grad_penalty`), 'r1' (on the real samples), or 'r2' (on the fake
+    ones, see `grad_penalty_reg`), weighted by `gamma`.
+
+    To cut its cost, the penalty can be computed on a random `fraction` of
+    the batch (at least 1 sample), and on a random spatial patch of
+    `patch_size` of the discriminator inputs.
+    Otherwise R1/R2 can reuse the discriminator forward on the real/fake
+    samples, see `reuse`, without any extra forward.
+
+    The timing of the discriminator steps with and without the penalty can
+    be recorded by `step_begin` and `step_end` to report its cost.
+    """
+    def __init__(self, kind='wgan', gamma=10, fraction=1, patch_size=None):
+        if kind not in ('wgan', 'r1', 'r2'):
+            raise ValueError('gradient penalty {} not supported'.format(kind))
+
+        self.kind = kind
+        self.gamma = gamma
+        self.fraction = fraction
+        self.patch_size = patch_size
+
+        self.timers = {}
+        self._step = None
+
+    @property
+    def reuse(self):
+        """Whether R1/R2 is computed on the whole real/fake samples, reusing
+        their discriminator forward, see `penalty`.
+        """
+        return (self.kind != 'wgan' and self.fraction >= 1
+                and self.patch_size is None)
+
+    def __call__(self, critic, fake, real, style=None):
+        """Penalty by an extra `critic` forward on a subset of the samples.
+        """
+        x, style = self.sample(fake, real, style=style)
+
+        score = critic(x, style=style)
+
+        return self.penalty(score, x)
+
+    def sample(self, fake, real, style=None):
+        """Random subset and patch of the penalty inputs, requiring grad,
+        with the corresponding `style` if given.
+        """
+        N = len(real)
+        n = max(round(N * self.fraction), 1)
+        index = None
+        if n < N:
+            index = torch.randperm(N, device=real.device)[:n]
+            fake, real = fake[index], real[index]
+            if style is not None:
+                style = style[index]
+
+        if self.patch_size is not None:
+            fake, real = random_patch((fake, real), self.patch_size)
+
+        if self.kind == 'wgan':
+            alpha = torch.rand(n, device=real.device)
+            alpha = alpha.reshape(n, *(1,) * (real.dim() - 1))
+            x = alpha * fake.detach() + (1 - alpha) * real.detach()
+        elif self.kind == 'r1':
+            x = real.detach()
+        else:
+            x = fake.detach()
+
+        return x.requires_grad_(True), style
+
+    def penalty(self, score, x):
+        """Penalty on the gradient of `score` w.r.t. `x`, keeping the graph
+        to backpropagate to the discriminator.
+        """
+        if self.kind != 'wgan':
+            return grad_penalty_reg(score, x, gamma=self.gamma)
+
+        # average over spatial dimensions if present
+        score = score.flatten(start_dim=1).mean(dim=1)
+        # sum over batches because graphs are mostly independent
+        score = score.sum()
+
+        grad, = torch.autograd.grad(
+            score,
+            x,
+            retain_graph=True,
+            create_graph=True,
+            only_inputs=True,
+        )
+
+        grad = grad.flatten(start_dim=1)
+
+        return self.gamma * ((grad.norm(p=2, dim=1) - 1) ** 2).mean()
+
+    def step_begin(self, device):
+        self._step = StepTimer(device)
+
+    def step_end(self, penalized):
+        self._step.stop()
+        self.timers[penalized] = self._step
+
+    def cost(self):
+        """Time in seconds of the latest discriminator step with the penalty,
+        and its overhead fraction relative to the latest step without.
+
+        Wait for both steps if on GPUs.
+        """
+        if True not in self.timers:
+            return None, None
+
+        step_time = self.timers[True].elapsed()
+        overhead = None
+        if False in self.timers:
+            overhead = step_time / self.timers[False].elapsed() - 1
+
+        return step_time, overhead
+
+
+class StepTimer:
+    """Wall time between its creation and `stop`, by CUDA events on GPUs so
+    as not to sync until `elapsed`.
+    """
+    def __init__(self, device):
+        self.cuda = torch.device(device).type == 'cuda'
+        if self.cuda:
+            self.start = torch.cuda.Event(enable_timing=True)
+            self.end = torch.cuda.Event(enable_timing=True)
+            self.start.record()
+        else:
+            self.start = time.perf_counter()
+
+    def stop(self):
+        if self.cuda:
+            self.end.record()
+        else:
+            self.end = time.perf_counter()
+
+    def elapsed(self):
+        if self.cuda:
+            self.end.synchronize()
+            return self.start.elapsed_time(self.end) / 1000
+        return self.end - self.start
+
+
+def random_patch(tensors, size):
+    """The same random spatial patch of `size` of all `tensors`.
+    """
+    spatial = tensors[0].shape[2:]
+    size = [min(size, s) for s in spatial]
+    start = [torch.randint(s - p + 1, ()).item()
+             for s, p in zip(spatial, size)]
+
+    ind = (slice(None),) * 2 + tuple(slice(b, b + p)
+                                     for b, p in zip(start, size))
+
+    return [t[ind] for t in tensors]
+
+
 def adv_model_wrapper(module):
     """Wrap an adversary model to also take lists of Tensors as input,
     to be concatenated along the batch dimension
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import fcntl
+import threading
+import weakref
+from contextlib import contextmanager
+import numpy as np
+import torch
+
+
+METHODS = ('grouped', 'dense')
+MEMORY_FORMATS = {
+    'contiguous': torch.contiguous_format,
+    'channels_last_3d': torch.channels_last_3d,
+}
+
+
+class ConvTuner:
+    """Autotuner of the `ConvStyled3d` execution, cached in a JSON file at
+    `path` across runs.
+
+    Every layer call is keyed by its signature, of the device, the versions,
+    the dtype, the input and weight shapes, whether the style is shared by
+    the batch, and whether it runs backward.
+    At the first call of a signature, every candidate of
+    - the method, 'grouped' (convolution with a modulated weight per sample)
+      or 'dense' (a single modulated weight if the style is shared,
+      otherwise modulating the activations instead),
+    - the memory format, NCDHW or channels_last_3d, and
+    - on GPUs, the cuDNN algorithm by benchmark or by heuristics,
+    is timed on the actual inputs, by the median of `steps` after `warmup`,
+    including the backward if grad is required, without accumulating grads.
+    The winner is added to the file, so that the restarts skip both the
+    tuning and, where the heuristics win, the cuDNN benchmarking.
+
+    The file is updated under a lock, merging the entries of concurrent
+    processes.
+    The global `torch.backends.cudnn.benchmark` should be left off, not to
+    benchmark the untuned layers and the backward regardless.
+    """
+    def __init__(self, path, steps=5, warmup=2):
+        self.path = path
+        self.steps = steps
+        self.warmup = warmup
+
+        self.configs = {}
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                self.configs = json.load(f)
+
+        self.lock = threading.Lock()
+        self.style = None  # cached sharing of the last style tensor
+
+    def __deepcopy__(self, memo):
+        return self  # shared by the copies of the model, e.g. by `probe`
+
+    def __call__(self, layer, x, s):
+        """Run `layer` on `(x, s)` with the tuned config.
+        """
+        if x.device.type == 'meta':
+            return layer.run(x, s, 'grouped')
+
+        shared = self.shared(s)
+        key = self.key(layer, x, shared)
+
+        with self.lock:
+            config = self.configs.get(key)
+            if config is None:
+                config = self.tune(layer, x, s, shared)
+                self.save(key, config)
+
+        return self.run(layer, x, s, config, shared)
+
+    def run(self, layer, x, s, config, shared):
+        x = x.contiguous(memory_format=MEMORY_FORMATS[config['memory_format']])
+        with cudnn_benchmark(config['benchmark']):
+            return layer.run(x, s, config['method'], shared=shared)
+
+    def tune(self, layer, x, s, shared):
+        configs = [{'method': m, 'memory_format': f, 'benchmark': b}
+                   for m in METHODS for f in MEMORY_FORMATS
+                   for b in ((False, True) if x.is_cuda else (False,))]
+
+        grad = torch.is_grad_enabled()
+        params = [p for p in layer.parameters() if p.requires_grad]
+        x = x.detach().requires_grad_(grad and x.requires_grad)
+        inputs = params + [x] if x.requires_grad else params
+
+        for config in configs:
+            times = []
+            for step in range(self.warmup + self.steps):
+                sync(x.device)
+                tic = time.perf_counter()
+
+                out = self.run(layer, x, s, config, shared)
+                if grad and inputs:
+                    torch.autograd.grad(out, inputs,
+                                        grad_outputs=torch.ones_like(out),
+                                        allow_unused=True)
+                del out
+
+                sync(x.device)
+                times.append(time.perf_counter() - tic)
+
+            config['time'] = float(np.median(times[self.warmup:]))
+
+        return min(configs, key=lambda c: c['time'])
+
+    def key(self, layer, x, shared):
+        if x.is_cuda:
+            device = torch.cuda.get_device_name(x.device)
+            cudnn = torch.backends.cudnn.version()
+        else:
+            device, cudnn = 'cpu', None
+        return json.dumps([
+            device, torch.__version__, cudnn, str(x.dtype).split('.')[-1],
+            list(x.shape), list(layer.weight.shape), layer.stride,
+            layer.resample, shared, torch.is_grad_enabled(),
+        ])
+
+    def shared(self, s):
+        """Whether all the samples share the style, checked once per style
+        tensor, e.g. for all the layers of a model call.
+        """
+        style = self.style
+        if style is not None and style[0]() is s and style[1] == s._version:
+            return style[2]
+
+        shared = len(s) == 1 or bool((s == s[:1]).all())
+        self.style = weakref.ref(s), s._version, shared
+        return shared
+
+    def save(self, key, config):
+        self.configs[key] = config
+
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path, 'r') as f:
+                        configs = json.load(f)
+                except FileNotFoundError:
+                    configs = {}
+                configs.update(self.configs)
+                self.configs = configs
+
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(configs, f, indent=1)
+                os.replace(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def set_conv_tuner(model, tuner):
+    """Let all the `ConvStyled3d` layers of `model` run by `tuner`, or by
+    default if None.
+    """
+    from .style import ConvStyled3d
+
+    for m in model.modules():
+        if isinstance(m, ConvStyled3d):
+            m.tuner = tuner
+
+
+@contextmanager
+def cudnn_benchmark(benchmark):
+    """Set `torch.backends.cudnn.benchmark` within the context.
+    """
+    cudnn = torch.backends.cudnn
+    prev = cudnn.benchmark
+    cudnn.benchmark = benchmark
+    try:
+        yield
+    finally:
+        cudnn.benchmark = prev
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
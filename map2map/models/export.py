@@ -0,0 +1,123 @@
+import copy
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .style import ConvStyled3d
+from . import srsgan, styled_srsgan
+from .noise import hash_noise
+
+
+class FrozenConv3d(nn.Module):
+    """Plain convolution with the modulated and demodulated weight of a
+    `ConvStyled3d` precomputed for a fixed style.
+
+    Take the same `(x, s)` inputs, with `s` ignored, so that it can replace
+    the styled layer in place.
+    """
+    def __init__(self, conv, style):
+        super().__init__()
+
+        with torch.no_grad():
+            s = conv.style_block(style.reshape(1, -1))
+
+            if conv.resample == 'U':
+                s = s.reshape(-1, 1, 1, 1, 1)
+                fan_in_dim = (0, 2, 3, 4)
+            else:
+                s = s.reshape(1, -1, 1, 1, 1)
+                fan_in_dim = (1, 2, 3, 4)
+
+            w = conv.weight * s
+            w = w * torch.rsqrt(w.pow(2).sum(dim=fan_in_dim, keepdim=True)
+                                + 1e-8)
+
+        self.register_buffer('weight', w)
+        bias = conv.bias
+        if bias is not None:
+            bias = bias.detach().clone()
+        self.register_buffer('bias', bias)
+
+        self.stride = conv.stride
+        self.transposed = conv.resample == 'U'
+
+    def forward(self, inputs):
+        x = inputs[0]
+
+        if self.transposed:
+            return F.conv_transpose3d(x, self.weight, bias=self.bias,
+                                      stride=self.stride)
+        return F.conv3d(x, self.weight, bias=self.bias, stride=self.stride)
+
+
+class FrozenNoise(nn.Module):
+    """`AddNoise` (adding, not concatenating) with the std as a buffer.
+
+    By default the noise is drawn from the global RNG as usual.
+    With a `seed`, it is drawn from a generator reset to `seed` at every
+    call, i.e. the same noise for all inputs of the same shape.
+    Given the global `origin` of the inputs, it is hashed from the positions
+    instead, as by `AddNoise`.
+    """
+    def __init__(self, noise, seed=None):
+        super().__init__()
+
+        self.register_buffer('std', noise.std.detach().clone())
+        self.seed = seed
+        self.stream = noise.stream
+
+    def forward(self, x, origin=None, seed=0):
+        if origin is not None:
+            noise = hash_noise(x, origin, seed=seed, stream=self.stream)
+        elif self.seed is None:
+            noise = torch.randn_like(x[:, :1])
+        else:
+            gen = torch.Generator(device=x.device)
+            gen.manual_seed(self.seed)
+            noise = torch.randn(x[:, :1].shape, generator=gen,
+                                dtype=x.dtype, device=x.device)
+
+        std_shape = (-1,) + (1,) * (x.dim() - 2)
+
+        return x + self.std.view(std_shape) * noise
+
+
+def freeze_style(model, style, noise_seed=None, example=None,
+                 example_kwargs=None):
+    """Export an inference-only copy of `model`, e.g. `styled_srsgan.G`, for
+    a fixed `style` vector, as constant within a snapshot.
+
+    Every `ConvStyled3d` is replaced by a `FrozenConv3d`, skipping the style
+    block, the weight (de)modulation, and the grouped convolution at every
+    call. `AddNoise` is replaced by `FrozenNoise` seeded by `noise_seed`.
+    The copy is still called as `model(x, style=style)`, ignoring the style,
+    and works with any batch size of inputs of that style.
+
+    With an `example` input batch, the copy is traced by `torch.jit.trace`,
+    unless the noise is seeded.
+    The `example_kwargs`, e.g. the `origin` and `seed` of the anchored noise,
+    are traced as inputs too, and must then be passed at every call.
+    """
+    model = copy.deepcopy(model)
+    model.eval()
+    model.requires_grad_(False)
+
+    param = next(model.parameters())
+    style = style.reshape(1, -1).to(param.device, param.dtype)
+
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, ConvStyled3d):
+                setattr(module, name, FrozenConv3d(child, style))
+            elif (isinstance(child, (srsgan.AddNoise, styled_srsgan.AddNoise))
+                  and not child.cat):
+                setattr(module, name, FrozenNoise(child, seed=noise_seed))
+
+    if example is not None and noise_seed is None:
+        style = style.expand(len(example), -1)
+        kwargs = {'x': example, 'style': style, **(example_kwargs or {})}
+        with torch.no_grad():
+            model = torch.jit.trace(model, example_kwarg_inputs=kwargs,
+                                    check_trace=False)
+
+    return model
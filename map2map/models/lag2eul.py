@@ -1,5 +1,8 @@
+import math
 import itertools
+from functools import lru_cache
 import torch
+import torch.nn as nn
 
 from ..data.norms.cosmology import D
 
@@ -18,6 +21,17 @@ def pixel_shuffle_3d_inv(x, r):
     return x
 
 
+def pixel_shuffle_3d(x, r):
+    """Inverse of `pixel_shuffle_3d_inv`.
+    """
+    B, C, D, H, W = x.shape
+    C = C // r ** 3
+    x = x.reshape(B, C, r, r, r, D, H, W)
+    x = x.permute(0, 1, 5, 2, 6, 3, 7, 4)
+    x = x.reshape(B, C, D * r, H * r, W * r)
+    return x
+
+
 def lag2eul(
         dis,
         val=1.0,
@@ -29,19 +43,45 @@ def lag2eul(
         dis_std=6.0,
         boxsize=100.,
         meshsize=512,
+        chunk_size=2**18,
+        scheme='cic',
+        interlace=False,
         **kwargs):
     """Transform fields from Lagrangian description to Eulerian description
 
+    Functional form of `Lag2Eul`, see there.
+    """
+    return Lag2Eul(eul_scale_factor=eul_scale_factor, eul_pad=eul_pad,
+                   rm_dis_mean=rm_dis_mean, periodic=periodic,
+                   dis_std=dis_std, boxsize=boxsize, meshsize=meshsize,
+                   chunk_size=chunk_size, scheme=scheme,
+                   interlace=interlace)(dis, val=val, a=a)
+
+
+class Lag2Eul(nn.Module):
+    """Transform fields from Lagrangian description to Eulerian description
+
     Only works for 3d fields, output same mesh size as input.
 
     Use displacement fields `dis` to map the value fields `val` from Lagrangian
-    to Eulerian positions and then "paint" with CIC (trilinear) scheme.
+    to Eulerian positions and then "paint" with a mass assignment `scheme`,
+    'ngp', 'cic' (trilinear, default), 'tsc', or 'pcs', see `paint`.
     Displacement and value fields are paired when are sequences of the same
     length. If the displacement (value) field has only one entry, it is shared
     by all the value (displacement) fields.
 
     The Eulerian size is scaled by the `eul_scale_factor` and then padded by
-    the `eul_pad`.
+    the `eul_pad`. The mesh is painted directly in the layout of
+    `pixel_shuffle_3d_inv` by the `eul_scale_factor`, i.e. of shape
+    `(N, C * eul_scale_factor^3, D, H, W)` the same size as the input.
+
+    Particles of all samples are painted in chunks of `chunk_size` (all if
+    None), fewer for the wider schemes, bounding the memory of the
+    intermediate positions and kernels.
+
+    With `interlace`, the particles are painted twice, the second time
+    shifted by half a cell, and combined to reduce the aliasing, see
+    `interlace`.
 
     Common mean displacement of all inputs can be removed to bring more
     particles inside the box. Periodic boundary condition can be turned on.
@@ -50,106 +90,271 @@ def lag2eul(
     long as their ratio gives the right resolution. One can therefore set them
     to the values of the whole Lagrangian fields, and use smaller inputs.
 
+    The Lagrangian grid, the neighbors, and the mesh strides are cached by
+    shape, device, and dtype, and the growth factors by the scale factor `a`,
+    shared by all instances and calls.
+
     Implementation follows pmesh/cic.py by Yu Feng.
     """
-    # NOTE the following factor assumes the displacements have been normalized
-    # by data.norms.cosmology.dis, and thus undoes it
-    z = 1/a - 1
-
-    dis_norm = dis_std * D(z) * meshsize / boxsize  # to mesh unit
-    dis_norm *= eul_scale_factor
-
-    if isinstance(dis, torch.Tensor):
-        dis = [dis]
-    if isinstance(val, (float, torch.Tensor)):
-        val = [val]
-    if len(dis) != len(val) and len(dis) != 1 and len(val) != 1:
-        raise ValueError('dis-val field mismatch')
-
-    if any(d.dim() != 5 for d in dis):
-        raise NotImplementedError('only support 3d fields for now')
-    if any(d.shape[1] != 3 for d in dis):
-        raise ValueError('only support 3d displacement fields')
-
-    # common mean displacement of all inputs
-    # if removed, fewer particles go outside of the box
-    # common for all inputs so outputs are comparable in the same coords
-    d_mean = 0
-    if rm_dis_mean:
-        d_mean = sum(d.detach().mean((2, 3, 4), keepdim=True)
-                     for d in dis) / len(dis)
-
-    out = []
-    if len(dis) == 1 and len(val) != 1:
-        dis = itertools.repeat(dis[0])
-    elif len(dis) != 1 and len(val) == 1:
-        val = itertools.repeat(val[0])
-    for d, v in zip(dis, val):
-        dtype, device = d.dtype, d.device
-
-        N, DHW = d.shape[0], d.shape[2:]
-        DHW = torch.Size([s * eul_scale_factor + 2 * eul_pad for s in DHW])
-
-        if isinstance(v, float):
-            C = 1
+    def __init__(self, eul_scale_factor=2, eul_pad=0, rm_dis_mean=True,
+                 periodic=False, dis_std=6.0, boxsize=100., meshsize=512,
+                 chunk_size=2**18, scheme='cic', interlace=False):
+        super().__init__()
+
+        if scheme not in SCHEMES:
+            raise ValueError('scheme {} not supported'.format(scheme))
+
+        self.eul_scale_factor = eul_scale_factor
+        self.eul_pad = eul_pad
+        self.rm_dis_mean = rm_dis_mean
+        self.periodic = periodic
+        self.dis_std = dis_std
+        self.boxsize = boxsize
+        self.meshsize = meshsize
+        self.chunk_size = chunk_size
+        self.scheme = scheme
+        self.interlace = interlace
+
+    def forward(self, dis, val=1.0, a=0.3333):
+        r = self.eul_scale_factor
+        eul_pad = self.eul_pad
+
+        # NOTE the following factor assumes the displacements have been
+        # normalized by data.norms.cosmology.dis, and thus undoes it
+        dis_norm = self.dis_std * growth(float(a))
+        dis_norm *= self.meshsize / self.boxsize * r  # to mesh unit
+
+        if isinstance(dis, torch.Tensor):
+            dis = [dis]
+        if isinstance(val, (float, torch.Tensor)):
+            val = [val]
+        if len(dis) != len(val) and len(dis) != 1 and len(val) != 1:
+            raise ValueError('dis-val field mismatch')
+
+        if any(d.dim() != 5 for d in dis):
+            raise NotImplementedError('only support 3d fields for now')
+        if any(d.shape[1] != 3 for d in dis):
+            raise ValueError('only support 3d displacement fields')
+
+        # common mean displacement of all inputs
+        # if removed, fewer particles go outside of the box
+        # common for all inputs so outputs are comparable in the same coords
+        d_mean = 0
+        if self.rm_dis_mean:
+            d_mean = sum(d.detach().mean((2, 3, 4), keepdim=True)
+                         for d in dis) / len(dis)
+
+        out = []
+        if len(dis) == 1 and len(val) != 1:
+            dis = itertools.repeat(dis[0])
+        elif len(dis) != 1 and len(val) == 1:
+            val = itertools.repeat(val[0])
+        for d, v in zip(dis, val):
+            dtype, device = d.dtype, d.device
+
+            N, DHW = d.shape[0], d.shape[2:]
+            grid = lagrangian_grid(DHW, r, device, dtype)
+            DHW = torch.Size([s * r + 2 * eul_pad for s in DHW])
+            if any(s % r != 0 for s in DHW):
+                raise ValueError('Eulerian size {} not divisible by the scale '
+                                 'factor {}'.format(tuple(DHW), r))
+
+            if isinstance(v, float):
+                C = 1
+            else:
+                C = v.shape[1]
+                # particles of all samples along one axis
+                v = v.flatten(start_dim=2).transpose(0, 1).flatten(start_dim=1)
+
+            pos = (d - d_mean) * dis_norm
+            del d
+
+            for i in range(3):
+                pos[:, i] += grid[i]
+
+            pos = pos.flatten(start_dim=2).transpose(0, 1).flatten(start_dim=1)
+
+            mesh = self._paint(pos, v, N, C, DHW)
+
+            if self.interlace:
+                mesh2 = self._paint(pos + 0.5, v, N, C, DHW)
+                mesh = interlace(mesh, mesh2, r)
+
+            out.append(mesh)
+
+        return out
+
+    def _paint(self, pos, val, N, C, DHW):
+        """Paint in chunks the particles of `N` samples at `pos` of shape
+        `(3, N * P)` with values `val` of shape `(C, N * P)` (or a float).
+        """
+        r = self.eul_scale_factor
+        order = SCHEMES[self.scheme]
+
+        # painted directly in the pixel-unshuffled layout
+        mesh = torch.zeros(N, C * r ** 3, *(s // r for s in DHW),
+                           dtype=pos.dtype, device=pos.device)
+
+        NP = pos.shape[1]
+        P = NP // N
+        chunk_size = NP
+        if self.chunk_size is not None:  # bounded as for the 8 CIC neighbors
+            chunk_size = max(self.chunk_size * 8 // order ** 3, 1)
+
+        for start in range(0, NP, chunk_size):
+            stop = min(start + chunk_size, NP)
+            src = val if isinstance(val, float) else val[:, start:stop]
+            sample = torch.arange(start, stop, device=pos.device) // P
+            paint(mesh, pos[:, start:stop], src, sample, DHW, r,
+                  periodic=self.periodic, order=order)
+
+        return mesh
+
+
+# mass assignment schemes by their orders, i.e. supports in cells
+SCHEMES = {'ngp': 1, 'cic': 2, 'tsc': 3, 'pcs': 4}
+
+
+def paint(mesh, pos, val, sample, DHW, r=1, periodic=False, order=2):
+    """Paint a chunk of particles at `pos` of shape `(3, P)` in mesh unit,
+    of samples `sample` of shape `(P,)`, with values `val` of shape `(C, P)`
+    (or a float) into `mesh` of the Eulerian size `DHW`, pixel-unshuffled
+    by `r` to shape `(N, C * r^3, D/r, H/r, W/r)`.
+
+    The mass assignment is the B-spline of `order`, see `SCHEMES`, with the
+    weights separable into those along each axis.
+    Only the outer products of those over the `order^3` neighbors are
+    expanded, to index a flattened mesh batched over the samples.
+    Out of bounds neighbors get zero weights unless `periodic`.
+    """
+    device = pos.device
+
+    N, Cr3 = mesh.shape[:2]
+    C = Cr3 // r ** 3
+    L = mesh[0].numel() // C  # of a channel of a sample
+
+    # neighbors and weights along each axis, of shape (3, P, order)
+    start = torch.floor(pos - (order - 2) / 2).to(torch.long)
+    tgtpos = start.unsqueeze(-1) + support(order, device)
+    weight = bspline(pos.unsqueeze(-1) - tgtpos, order)
+    del start
+
+    bounds, rem_stride, quo_stride = mesh_strides(DHW, r, device)
+    if periodic:
+        tgtpos = torch.remainder(tgtpos, bounds)
+    else:
+        inside = (tgtpos >= 0) & (tgtpos < bounds)
+        weight = weight * inside
+        tgtpos = torch.where(inside, tgtpos, 0)
+        del inside
+
+    # flat index in the unshuffled layout, also separable
+    quo = torch.div(tgtpos, r, rounding_mode='floor')
+    offset = (tgtpos - quo * r) * rem_stride + quo * quo_stride
+    del tgtpos, quo
+
+    ind = (offset[0, :, :, None, None] + offset[1, :, None, :, None]
+           + offset[2, :, None, None, :])
+    ind += (sample * C * L)[:, None, None, None]
+    weight = (weight[0, :, :, None, None] * weight[1, :, None, :, None]
+              * weight[2, :, None, None, :])
+    del offset
+
+    ind = ind.flatten()
+    weight = weight.flatten(start_dim=1)
+
+    mesh = mesh.view(-1)
+    for c in range(C):
+        if isinstance(val, float):
+            src = val * weight
         else:
-            C = v.shape[1]
-            v = v.contiguous().flatten(start_dim=2).unsqueeze(-1)
+            src = val[c, :, None] * weight
+        mesh.index_add_(0, ind + c * L, src.flatten())
 
-        mesh = torch.zeros(N, C, *DHW, dtype=dtype, device=device)
 
-        pos = (d - d_mean) * dis_norm
-        del d
+def bspline(s, order):
+    """Mass assignment weights of the B-spline of `order` at distances `s`
+    in mesh unit within its support.
+    """
+    if order == 1:
+        return torch.ones_like(s)
+
+    s = s.abs()
+    if order == 2:
+        return 1 - s
+    if order == 3:
+        return torch.where(s < 0.5, 0.75 - s ** 2, 0.5 * (1.5 - s) ** 2)
+    if order == 4:
+        return torch.where(s < 1, (4 - 6 * s ** 2 + 3 * s ** 3) / 6,
+                           (2 - s) ** 3 / 6)
+    raise ValueError('order {} not supported'.format(order))
+
+
+def interlace(mesh, mesh2, r=1):
+    """Interlace `mesh` with `mesh2` painted with the particles shifted by
+    half a cell along every axis, to reduce the aliasing.
+
+    `mesh2` is shifted back by a phase in Fourier space, assuming periodic
+    boundaries, and averaged with `mesh`.
+    Both are in the pixel-unshuffled layout by `r`, and so is the result.
+    """
+    if r > 1:
+        mesh, mesh2 = pixel_shuffle_3d(mesh, r), pixel_shuffle_3d(mesh2, r)
+
+    DHW = mesh.shape[2:]
+    kvec = [2 * math.pi * torch.fft.fftfreq(s, device=mesh.device)
+            for s in DHW[:-1]]
+    kvec.append(2 * math.pi * torch.fft.rfftfreq(DHW[-1], device=mesh.device))
+    ksum = (kvec[0][:, None, None] + kvec[1][:, None] + kvec[2])
 
-        pos[:, 0] += torch.arange(0.5, DHW[0] - 2 * eul_pad, eul_scale_factor,
-                                  dtype=dtype, device=device)[:, None, None]
-        pos[:, 1] += torch.arange(0.5, DHW[1] - 2 * eul_pad, eul_scale_factor,
-                                  dtype=dtype, device=device)[:, None]
-        pos[:, 2] += torch.arange(0.5, DHW[2] - 2 * eul_pad, eul_scale_factor,
-                                  dtype=dtype, device=device)
+    mesh = torch.fft.rfftn(mesh, dim=(2, 3, 4))
+    mesh2 = torch.fft.rfftn(mesh2, dim=(2, 3, 4))
+    mesh = (mesh + mesh2 * torch.exp(0.5j * ksum)) / 2
+    mesh = torch.fft.irfftn(mesh, s=DHW, dim=(2, 3, 4))
 
-        pos = pos.contiguous().view(N, 3, -1, 1)  # last axis for neighbors
+    if r > 1:
+        mesh = pixel_shuffle_3d_inv(mesh, r)
 
-        intpos = pos.floor().to(torch.int)
-        neighbors = (
-            torch.arange(8, device=device)
-            >> torch.arange(3, device=device)[:, None, None]
-        ) & 1
-        tgtpos = intpos + neighbors
-        del intpos, neighbors
+    return mesh
 
-        # CIC
-        kernel = (1.0 - torch.abs(pos - tgtpos)).prod(1, keepdim=True)
-        del pos
 
-        v = v * kernel
-        del kernel
+@lru_cache(maxsize=None)
+def growth(a):
+    """Linear growth function `D` at scale factor `a`.
+    """
+    return D(1 / a - 1)
 
-        tgtpos = tgtpos.view(N, 3, -1)  # fuse spatial and neighbor axes
-        v = v.view(N, C, -1)
 
-        for n in range(N):  # because ind has variable length
-            bounds = torch.tensor(DHW, device=device)[:, None]
+@lru_cache(maxsize=16)
+def lagrangian_grid(DHW, r, device, dtype):
+    """Eulerian mesh positions of the Lagrangian particles on a grid of size
+    `DHW` scaled by `r`, along each axis and shaped to broadcast over it.
+    """
+    return tuple(
+        torch.arange(0.5, s * r, r, dtype=dtype, device=device).view(
+            (-1,) + (1,) * (2 - i))
+        for i, s in enumerate(DHW)
+    )
 
-            if periodic:
-                torch.remainder(tgtpos[n], bounds, out=tgtpos[n])
 
-            ind = (tgtpos[n, 0] * DHW[1] + tgtpos[n, 1]
-                   ) * DHW[2] + tgtpos[n, 2]
-            src = v[n]
+@lru_cache(maxsize=16)
+def support(order, device):
+    """Neighbor offsets within the support of `order` cells.
+    """
+    return torch.arange(order, device=device)
 
-            if not periodic:
-                mask = ((tgtpos[n] >= 0) & (tgtpos[n] < bounds)).all(0)
-                ind = ind[mask]
-                src = src[:, mask]
 
-            mesh[n].view(C, -1).index_add_(1, ind, src)
-        
-        if eul_scale_factor > 1:
-            #print(mesh.shape,'before shuffle')
-            mesh = pixel_shuffle_3d_inv(mesh, eul_scale_factor)
-            #print(mesh.shape,'after shuffle')
+@lru_cache(maxsize=16)
+def mesh_strides(DHW, r, device):
+    """Eulerian mesh size `DHW`, and the strides of the remainders and the
+    quotients of the positions by `r` in the pixel-unshuffled layout, each
+    of shape `(3, 1, 1)`.
+    """
+    Dr, Hr, Wr = (s // r for s in DHW)
+    V = Dr * Hr * Wr
 
-        out.append(mesh)
+    bounds = torch.tensor(DHW, device=device)
+    rem_stride = torch.tensor([r * r * V, r * V, V], device=device)
+    quo_stride = torch.tensor([Hr * Wr, Wr, 1], device=device)
 
-    return out
+    return tuple(x[:, None, None] for x in (bounds, rem_stride, quo_stride))
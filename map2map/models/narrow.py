@@ -1,5 +1,7 @@
+import math
 import torch
 import torch.nn as nn
+from torch.utils._python_dispatch import TorchDispatchMode
 
 
 def narrow_by(a, c):
@@ -40,3 +42,94 @@ def narrow_like(a, b):
         half_width = width // 2
         a = a.narrow(d, half_width, a.shape[d] - width)
     return a
+
+
+class CropPool:
+    """Materialize narrowed views, e.g. of `narrow_cast`, into contiguous
+    buffers reused across steps, only for the consumers needing them
+    contiguous, e.g. the convolutions after a concatenation.
+
+    Ops taking strided inputs, e.g. the elementwise losses and `lag2eul`,
+    should be fed the views directly instead.
+    A buffer is reused by the same `key` until the shape changes, and must not
+    be needed after the next use of the key.
+    Autograd does not support `out=`, so the tensors requiring grad are still
+    copied to new ones, but counted as well.
+
+    `copies` and `bytes` count the copies since the last `step`, which
+    returns and resets them.
+    """
+    def __init__(self):
+        self.buffers = {}
+        self.copies = 0
+        self.bytes = 0
+
+    def cat(self, tensors, dim=1, key=None):
+        """Concatenate `tensors` along `dim` with a single copy.
+        """
+        shape = list(tensors[0].shape)
+        shape[dim] = sum(x.shape[dim] for x in tensors)
+        dtype = tensors[0].dtype
+
+        self._count(shape, dtype)
+
+        if key is None or _needs_grad(*tensors):
+            return torch.cat(tensors, dim=dim)
+
+        buf = self._buffer(key, shape, dtype, tensors[0].device)
+        return torch.cat(tensors, dim=dim, out=buf)
+
+    def step(self):
+        """Return the counts of copies and bytes since the last step, and
+        reset them.
+        """
+        counts = self.copies, self.bytes
+        self.copies = self.bytes = 0
+        return counts
+
+    def _count(self, shape, dtype):
+        self.copies += 1
+        self.bytes += math.prod(shape) * dtype.itemsize
+
+    def _buffer(self, key, shape, dtype, device):
+        buf = self.buffers.get(key)
+        if (buf is None or buf.shape != torch.Size(shape)
+                or buf.dtype != dtype or buf.device != device):
+            buf = torch.empty(shape, dtype=dtype, device=device)
+            self.buffers[key] = buf
+        return buf
+
+
+def _needs_grad(*tensors):
+    return torch.is_grad_enabled() and any(x.requires_grad for x in tensors)
+
+
+class CopyCounter(TorchDispatchMode):
+    """Count all the copies dispatched, including those hidden inside ops,
+    e.g. `contiguous` of a narrowed view, or the implicit casts, for
+    debugging.
+
+    Use as a context manager around a step, after which `copies` and `bytes`
+    hold the counts of the forward and backward.
+    """
+    ops = {
+        torch.ops.aten.clone.default,
+        torch.ops.aten.copy_.default,
+        torch.ops.aten._to_copy.default,
+        torch.ops.aten.cat.default,
+        torch.ops.aten.cat.out,
+    }
+
+    def __init__(self):
+        super().__init__()
+        self.copies = 0
+        self.bytes = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+
+        if func in self.ops and isinstance(out, torch.Tensor):
+            self.copies += 1
+            self.bytes += out.numel() * out.element_size()
+
+        return out
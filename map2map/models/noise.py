@@ -0,0 +1,65 @@
+import math
+import torch
+
+
+MASK = 0xffffffff
+
+
+def hash32(x):
+    """Integer hash (lowbias32 by C. Wellons) of the low 32 bits of int64
+    tensor `x`, elementwise.
+
+    The products overflow int64 but wrap around, keeping the low 32 bits.
+    """
+    x = x & MASK
+    x = x ^ (x >> 16)
+    x = (x * 0x7feb352d) & MASK
+    x = x ^ (x >> 15)
+    x = (x * 0x846ca68b) & MASK
+    x = x ^ (x >> 16)
+    return x
+
+
+def hash_noise(x, origin, seed=0, stream=0):
+    """Standard normal noise of the shape of `x[:, :1]`, as a function of the
+    `seed`, the `stream`, and the global voxel positions only, i.e. the same
+    wherever a voxel falls in a patch.
+
+    `origin` is the global position of the first voxel of every sample, of
+    shape `(N, ndim)`, and `seed` is an int or one per sample.
+    The voxel coordinates are hashed along every dimension in turn, each
+    broadcast to one more dimension, and then 2 uniforms of the hashed key are
+    transformed to a normal by Box-Muller.
+    Nothing is drawn from the global RNG, or stored between calls.
+    """
+    N, _, *size = x.shape
+    device = x.device
+
+    origin = torch.as_tensor(origin, dtype=torch.int64, device=device)
+    origin = origin.reshape(N, len(size))
+    seed = torch.as_tensor(seed, dtype=torch.int64, device=device)
+    seed = seed.expand(N) if seed.dim() == 0 else seed.reshape(N)
+
+    key = hash32(seed * 0x9e3779b9 + hash32(torch.tensor(stream,
+                                                         device=device)))
+    key = key.reshape((N,) + (1,) * len(size))
+    for d, s in enumerate(size):
+        shape = (N,) + (1,) * d + (s,) + (1,) * (len(size) - d - 1)
+        coord = origin[:, d, None] + torch.arange(s, device=device)
+        key = hash32(key + coord.reshape(shape))
+
+    # top 24 bits, exact in single precision
+    u1 = ((hash32(key ^ 0x68e31da4) >> 8).float() + 0.5) * 2 ** -24
+    u2 = (hash32(key ^ 0xb5297a4d) >> 8).float() * 2 ** -24
+    noise = torch.sqrt(-2 * torch.log(u1)) * torch.cos(2 * math.pi * u2)
+
+    return noise.unsqueeze(1).to(x.dtype)
+
+
+def narrowed_origin(origin, size, new_size, scale=1):
+    """Global origin of a field of spatial `new_size`, symmetrically narrowed
+    from `scale` times that of spatial `size` at `origin`, in the finer
+    resolution.
+    """
+    offset = [(scale * s - t) // 2 for s, t in zip(size, new_size)]
+    return scale * origin + torch.tensor(offset, device=origin.device)
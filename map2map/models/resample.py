@@ -1,3 +1,4 @@
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -20,10 +21,86 @@ def resample(x, scale_factor, narrow=True):
     return x
 
 
+def upsample2(x, out=None):
+    """Linear upsampling by 2 of only the interior, i.e. the same as
+    `resample(x, 2)` (narrowed by 1) without the discarded edges.
+
+    Each output pair interleaves 0.75 and 0.25 weights of 2 neighboring
+    inputs, along each dimension in turn.
+    The result is written to `out` if given, e.g. a reused buffer, and is
+    differentiable.
+    """
+    return Upsample2.apply(x, out)
+
+
+class Upsample2(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, out=None):
+        ctx.shape = x.shape
+
+        dims = range(2, x.dim())
+        for d in dims:
+            x = _interleave(x, d, out=out if d == dims[-1] else None)
+
+        if out is not None:
+            ctx.mark_dirty(out)
+            return out
+
+        return x
+
+    @staticmethod
+    def backward(ctx, grad):
+        # adjoint along each dimension in the reverse order
+        for d in reversed(range(2, grad.dim())):
+            grad = _interleave_adjoint(grad, d)
+
+        return grad, None
+
+
+def _interleave(x, d, out=None):
+    n = x.shape[d]
+    a, b = x.narrow(d, 0, n - 1), x.narrow(d, 1, n - 1)
+
+    # 0.75 a + 0.25 b and 0.25 a + 0.75 b
+    mean = torch.add(a, b).mul_(0.5)
+    half_diff = torch.sub(a, b).mul_(0.25)
+
+    shape = list(mean.shape)
+    shape.insert(d + 1, 2)
+    if out is None:
+        y = torch.empty(shape, dtype=x.dtype, device=x.device)
+    else:
+        y = out.view(shape)
+    torch.add(mean, half_diff, out=y.select(d + 1, 0))
+    torch.sub(mean, half_diff, out=y.select(d + 1, 1))
+
+    return y.flatten(d, d + 1)
+
+
+def _interleave_adjoint(grad, d):
+    shape = list(grad.shape)
+    n = shape[d] // 2 + 1
+    shape[d:d + 1] = [n - 1, 2]
+    grad = grad.reshape(shape)
+    g0, g1 = grad.select(d + 1, 0), grad.select(d + 1, 1)
+
+    mean = torch.add(g0, g1).mul_(0.5)
+    half_diff = torch.sub(g0, g1).mul_(0.25)
+
+    shape = list(mean.shape)
+    shape[d] = n
+    x = mean.new_zeros(shape)
+    x.narrow(d, 0, n - 1).add_(mean).add_(half_diff)
+    x.narrow(d, 1, n - 1).add_(mean).sub_(half_diff)
+
+    return x
+
+
 class Resampler(nn.Module):
     """Resampling, upsampling or downsampling.
 
     By default discard the inaccurate edges when upsampling.
+    Upsampling by 2 then only computes the voxels kept, see `upsample2`.
     """
     def __init__(self, ndim, scale_factor, narrow=True):
         super().__init__()
@@ -35,6 +112,9 @@ class Resampler(nn.Module):
         self.narrow = narrow
 
     def forward(self, x):
+        if self.scale_factor == 2 and self.narrow == True:
+            return upsample2(x)
+
         x = F.interpolate(x, scale_factor=self.scale_factor,
                           mode=self.mode, align_corners=False)
 
@@ -64,6 +144,10 @@ class Resampler2(nn.Module):
 
     def forward(self, inputs):
         x = inputs[0]
+
+        if self.scale_factor == 2 and self.narrow == True:
+            return upsample2(x)
+
         x = F.interpolate(x, scale_factor=self.scale_factor,
                           mode=self.mode, align_corners=False)
 
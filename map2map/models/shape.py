@@ -0,0 +1,118 @@
+import copy
+import math
+import numpy as np
+import torch
+
+
+def probe(model, in_chan, size, style_size=0, batch_size=1):
+    """Run a copy of `model` on a meta input of `size` (including the pad),
+    without allocating memory or computing anything.
+
+    Forward hooks introspect every leaf module and convolution (e.g. the
+    styled ones with style blocks inside), so all the narrowing from
+    convolution kernels, resampling, and `narrow_by` in the forward is
+    accounted for.
+
+    Return the output size, and for every convolution a tuple of its name,
+    the MACs per output voxel, and the output size, and the bytes of the
+    input plus the output of every module call hooked.
+    """
+    model = copy.deepcopy(model).to('meta')
+
+    convs = []
+    activations = []
+
+    def hook(module, input, output):
+        input = first_tensor(input)
+        if input is None or not isinstance(output, torch.Tensor):
+            return
+
+        activations.append(sum(x.numel() * x.element_size()
+                               for x in (input, output)))
+
+        weight = getattr(module, 'weight', None)
+        if (isinstance(weight, torch.Tensor) and output.dim() > 2
+                and weight.dim() == output.dim()):
+            macs = weight.numel()
+            stride = getattr(module, 'stride', 1)
+            if (isinstance(module, torch.nn.ConvTranspose3d)
+                    or getattr(module, 'resample', None) == 'U'
+                    or getattr(module, 'transposed', False)):
+                macs /= np.prod(np.broadcast_to(stride, (output.dim() - 2,)))
+            convs.append((names[module], macs, output.shape[2]))
+
+    names = {}
+    handles = []
+    for name, module in model.named_modules():
+        weight = getattr(module, 'weight', None)
+        if (len(list(module.children())) == 0
+                or isinstance(weight, torch.Tensor) and weight.dim() > 2):
+            names[module] = name
+            handles.append(module.register_forward_hook(hook))
+
+    x = torch.empty(batch_size, in_chan, *(size,) * 3, device='meta')
+    kwargs = {}
+    if style_size > 0:
+        kwargs['style'] = torch.empty(batch_size, style_size, device='meta')
+    with torch.no_grad():
+        y = model(x, **kwargs)
+
+    for h in handles:
+        h.remove()
+
+    return y.shape[2], convs, activations
+
+
+def first_tensor(x):
+    """First tensor in possibly nested tuples, e.g. `(x, s)` of the styled
+    layers.
+    """
+    if isinstance(x, torch.Tensor):
+        return x
+    if isinstance(x, (tuple, list)):
+        for y in x:
+            y = first_tensor(y)
+            if y is not None:
+                return y
+    return None
+
+
+def shape_info(model, size, in_chan, style_size=0, batch_size=1):
+    """Shape inference of any model in `map2map.models`, e.g. `VNet` or
+    `styled_srsgan.G`, on inputs of `size` (a multiple of the total
+    downsampling), by `probe` on the meta device, i.e. without running it.
+
+    The output size is affine in the input size, `out = scale * in + offset`,
+    fit by 2 probes of `size` and twice that.
+    The pad is the least input context on each side to have the output cover
+    the unpadded input (times `scale`), and the receptive field is the input
+    extent of that context around a voxel, both from the valid narrowing.
+    The memory estimate is the peak bytes of the input plus output of a layer
+    for a batch, not including the parameters, which are counted separately.
+
+    Return a dict of 'out_size', 'scale', 'offset', 'pad', 'receptive_field',
+    'mem', and 'param_mem'.
+    """
+    size = int(size)
+
+    out0, _, activations = probe(model, in_chan, size, style_size=style_size,
+                                 batch_size=batch_size)
+    out1, _, _ = probe(model, in_chan, 2 * size, style_size=style_size)
+
+    scale = (out1 - out0) / size
+    offset = out0 - scale * size
+
+    pad = max(math.ceil(- offset / (2 * scale)), 0)
+
+    param_mem = sum(p.numel() * p.element_size()
+                    for p in model.parameters())
+
+    return {
+        'out_size': out0,
+        'scale': scale,
+        'offset': offset,
+        'pad': pad,
+        'receptive_field': 2 * pad + 1,
+        'mem': max(activations),
+        'param_mem': param_mem,
+    }
@@ -1,20 +1,178 @@
+import copy
+import time
+import numpy as np
+import torch
 import torch.nn as nn
 from torch.nn.utils import spectral_norm, remove_spectral_norm
+from torch.nn.utils.spectral_norm import SpectralNorm
 
 
-def add_spectral_norm(module):
+LAYERS = (nn.Linear, nn.Conv1d, nn.Conv2d, nn.Conv3d,
+          nn.ConvTranspose1d, nn.ConvTranspose2d, nn.ConvTranspose3d)
+
+
+class AmortizedSpectralNorm(SpectralNorm):
+    """Spectral normalization with the power iteration amortized over the
+    training steps.
+
+    `torch.nn.utils.spectral_norm` refreshes `u` and `v` at every forward in
+    training, e.g. 3 times per step for the fake, real, and penalty passes of
+    a discriminator.
+    Here the refresh is done only at the first forward after the weight is
+    updated (by the optimizer or loading a state), i.e. once per step, and
+    only every `interval` steps.
+    The other forwards reuse the cached copies of `u` and `v`, and thus the
+    same sigma, which still differentiates through the weight.
+
+    The parameter and buffers, `weight_orig`, `weight_u`, and `weight_v`,
+    and so the state dict keys, are the same as those of the former, so that
+    the checkpoints are interchangeable.
+    """
+    def __init__(self, fn, interval=1):
+        super().__init__(name=fn.name, n_power_iterations=fn.n_power_iterations,
+                         dim=fn.dim, eps=fn.eps)
+        self.interval = interval
+
+        self.version = None
+        self.updates = 0
+        self.uv = None
+
+    def __call__(self, module, inputs):
+        if module.training:
+            weight = getattr(module, self.name + '_orig')
+            if weight._version != self.version or self.uv is None:
+                do_power_iteration = self.updates % self.interval == 0
+                self.updates += 1
+                # cloned, since the buffers are updated in place, and
+                # broadcast in place by DDP
+                u, v = self._uv(module, do_power_iteration)
+                self.uv = u.clone(), v.clone()
+                self.version = weight._version
+            weight = self._compute_weight(module, *self.uv)
+        else:
+            weight = self.compute_weight(module, do_power_iteration=False)
+
+        setattr(module, self.name, weight)
+
+    def _uv(self, module, do_power_iteration):
+        weight = getattr(module, self.name + '_orig')
+        u = getattr(module, self.name + '_u')
+        v = getattr(module, self.name + '_v')
+
+        if do_power_iteration:
+            weight_mat = self.reshape_weight_to_matrix(weight)
+            with torch.no_grad():
+                for _ in range(self.n_power_iterations):
+                    v = nn.functional.normalize(torch.mv(weight_mat.t(), u),
+                                                dim=0, eps=self.eps, out=v)
+                    u = nn.functional.normalize(torch.mv(weight_mat, v),
+                                                dim=0, eps=self.eps, out=u)
+
+        return u, v
+
+    def _compute_weight(self, module, u, v):
+        weight = getattr(module, self.name + '_orig')
+        weight_mat = self.reshape_weight_to_matrix(weight)
+        sigma = torch.dot(u, torch.mv(weight_mat, v))
+        return weight / sigma
+
+
+def add_spectral_norm(module, interval=1):
+    """Add spectral normalization to all the linear and convolution layers,
+    with the power iteration amortized by `AmortizedSpectralNorm`.
+    """
     for name, child in module.named_children():
-        if isinstance(child, (nn.Linear, nn.Conv1d, nn.Conv2d, nn.Conv3d,
-            nn.ConvTranspose1d, nn.ConvTranspose2d, nn.ConvTranspose3d)):
-            setattr(module, name, spectral_norm(child))
+        if isinstance(child, LAYERS):
+            child = spectral_norm(child)
+            for k, hook in child._forward_pre_hooks.items():
+                if isinstance(hook, SpectralNorm):
+                    child._forward_pre_hooks[k] = AmortizedSpectralNorm(
+                        hook, interval=interval)
+            setattr(module, name, child)
         else:
-            add_spectral_norm(child)
+            add_spectral_norm(child, interval=interval)
 
 
 def rm_spectral_norm(module):
     for name, child in module.named_children():
-        if isinstance(child, (nn.Linear, nn.Conv1d, nn.Conv2d, nn.Conv3d,
-            nn.ConvTranspose1d, nn.ConvTranspose2d, nn.ConvTranspose3d)):
+        if isinstance(child, LAYERS):
             setattr(module, name, remove_spectral_norm(child))
         else:
             rm_spectral_norm(child)
+
+
+def bench_spectral_norm(module, input, passes=3, intervals=(1, 4, 16),
+                        steps=10, warmup=2, **kwargs):
+    """Benchmark the training step time of `module`, e.g. a discriminator,
+    on `input` without spectral normalization, with that of
+    `torch.nn.utils.spectral_norm`, and with the amortized one at every
+    `intervals`.
+
+    Every step runs `passes` forwards, e.g. fake, real, and penalty, one
+    backward, and an optimizer step, and the median step time is reported.
+    `kwargs` are passed to the forwards, e.g. `style`.
+
+    Return a list of dicts, with the overhead relative to no normalization.
+    """
+    device = input.device
+
+    def sync():
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+
+    base = copy.deepcopy(module)
+    for m in base.modules():
+        if hasattr(m, 'weight_orig'):
+            remove_spectral_norm(m)
+    base.train()
+
+    variants = [('none', None), ('torch', None)]
+    variants += [('amortized', i) for i in intervals]
+
+    results = []
+    for name, interval in variants:
+        model = copy.deepcopy(base)
+        if name == 'torch':
+            for parent in model.modules():
+                for n, child in parent.named_children():
+                    if isinstance(child, LAYERS):
+                        setattr(parent, n, spectral_norm(child))
+        elif name == 'amortized':
+            add_spectral_norm(model, interval=interval)
+        optimizer = torch.optim.SGD(model.parameters(), lr=0)
+
+        times = []
+        for step in range(warmup + steps):
+            sync()
+            tic = time.perf_counter()
+
+            optimizer.zero_grad(set_to_none=True)
+            loss = sum(model(input, **kwargs).mean() for _ in range(passes))
+            loss.backward()
+            optimizer.step()
+
+            sync()
+            times.append(time.perf_counter() - tic)
+
+        results.append({
+            'norm': name,
+            'interval': interval,
+            'step': float(np.median(times[warmup:])),
+        })
+
+    for r in results:
+        r['overhead'] = r['step'] / results[0]['step'] - 1
+
+    return results
+
+
+def format_spectral_norm(results):
+    """Format the benchmark results from `bench_spectral_norm` as a table.
+    """
+    lines = ['{:>10} {:>9} {:>10} {:>9}'.format(
+        'norm', 'interval', 'step [s]', 'overhead')]
+    for r in results:
+        lines.append('{:>10} {:>9} {:>10.4g} {:>9.1%}'.format(
+            r['norm'], '-' if r['interval'] is None else r['interval'],
+            r['step'], r['overhead']))
+    return '\n'.join(lines)
@@ -4,6 +4,7 @@ import torch.nn as nn
 
 from .narrow import narrow_by
 from .resample import Resampler
+from .noise import hash_noise, narrowed_origin
 
 
 class G(nn.Module):
@@ -32,15 +33,26 @@ class G(nn.Module):
         for b in range(num_blocks):
             prev_chan, next_chan = chan(b), chan(b+1)
             self.blocks.append(
-                HBlock(prev_chan, next_chan, out_chan, cat_noise))
+                HBlock(prev_chan, next_chan, out_chan, cat_noise,
+                       noise_stream=2 * b))
+
+    def forward(self, x, origin=None, seed=0):
+        """With the global `origin` of the first input voxel of every sample,
+        the noise is hashed from the `seed` and the global voxel positions,
+        and thus the same in overlapping patches, see `AddNoise`.
+        """
+        size = x.shape[2:]
 
-    def forward(self, x):
         y = x  # direct upsampling from the input
         x = self.block0(x)
 
         #y = None  # no direct upsampling from the input
-        for block in self.blocks:
-            x, y = block(x, y)
+        for b, block in enumerate(self.blocks):
+            block_origin = None
+            if origin is not None:
+                block_origin = narrowed_origin(origin, size, x.shape[2:],
+                                               scale=2 ** b)
+            x, y = block(x, y, origin=block_origin, seed=seed)
 
         return y
 
@@ -71,18 +83,19 @@ class HBlock(nn.Module):
     -----
     next_size = 2 * prev_size - 6
     """
-    def __init__(self, prev_chan, next_chan, out_chan, cat_noise):
+    def __init__(self, prev_chan, next_chan, out_chan, cat_noise,
+                 noise_stream=0):
         super().__init__()
 
         self.upsample = Resampler(3, 2)
 
         self.conv = nn.Sequential(
-            AddNoise(cat_noise, chan=prev_chan),
+            AddNoise(cat_noise, chan=prev_chan, stream=noise_stream),
             self.upsample,
             nn.Conv3d(prev_chan + int(cat_noise), next_chan, 3),
             nn.LeakyReLU(0.2, True),
 
-            AddNoise(cat_noise, chan=next_chan),
+            AddNoise(cat_noise, chan=next_chan, stream=noise_stream + 1),
             nn.Conv3d(next_chan + int(cat_noise), next_chan, 3),
             nn.LeakyReLU(0.2, True),
         )
@@ -92,15 +105,26 @@ class HBlock(nn.Module):
             nn.LeakyReLU(0.2, True),
         )
 
-    def forward(self, x, y):
-        x = self.conv(x)  # narrow by 3
+    def forward(self, x, y, origin=None, seed=0):
+        if origin is None:
+            x = self.conv(x)  # narrow by 3
+        else:
+            size, scale = x.shape[2:], 1
+            for module in self.conv:
+                if hasattr(module, 'stream'):  # AddNoise, or frozen
+                    x = module(x, origin=narrowed_origin(
+                        origin, size, x.shape[2:], scale=scale), seed=seed)
+                else:
+                    x = module(x)
+                if module is self.upsample:
+                    scale = 2
 
         if y is None:
             y = self.proj(x)
         else:
-            y = self.upsample(y)  # narrow by 1
-
-            y = narrow_by(y, 2)
+            # narrow by 1 (upsampled by 2) beforehand to skip the voxels
+            # discarded afterwards
+            y = self.upsample(narrow_by(y, 1))  # narrow by 1
 
             y = y + self.proj(x)
 
@@ -113,17 +137,27 @@ class AddNoise(nn.Module):
     Add noise if `cat=False`.
     The number of channels `chan` should be 1 (StyleGAN2)
     or that of the input (StyleGAN).
+
+    By default the noise is drawn from the global RNG.
+    Given the global `origin` of the first voxel of every sample, it is
+    instead hashed from the `seed`, the `stream` of this layer, and the
+    global voxel positions by `hash_noise`, so that the overlapping patches,
+    e.g. of any tiling, see the same noise.
     """
-    def __init__(self, cat, chan=1):
+    def __init__(self, cat, chan=1, stream=0):
         super().__init__()
 
         self.cat = cat
+        self.stream = stream
 
         if not self.cat:
             self.std = nn.Parameter(torch.zeros([chan]))
 
-    def forward(self, x):
-        noise = torch.randn_like(x[:, :1])
+    def forward(self, x, origin=None, seed=0):
+        if origin is None:
+            noise = torch.randn_like(x[:, :1])
+        else:
+            noise = hash_noise(x, origin, seed=seed, stream=self.stream)
 
         if self.cat:
             x = torch.cat([x, noise], dim=1)
@@ -89,6 +89,11 @@ class ConvStyled3d(nn.Module):
     """Convolution layer with modulation and demodulation, from StyleGAN2.
 
     Weight and bias initialization from `torch.nn._ConvNd.reset_parameters()`.
+
+    By default it runs a grouped convolution of a modulated weight per sample.
+    With a `tuner` (see `autotune.ConvTuner`), the method and the memory
+    format are chosen by timing, among others the 'dense' one, with a single
+    weight for a shared style, or modulating the activations otherwise.
     """
 
     def __init__(self, in_chan, out_chan, style_size, kernel_size=3, stride=1,
@@ -145,8 +150,25 @@ class ConvStyled3d(nn.Module):
         )
         self.style_block.apply(init_weight)
 
+        self.tuner = None
+
     def forward(self, inputs):
         x, s = inputs[0], inputs[1]
+
+        if self.tuner is not None:
+            return self.tuner(self, x, s)
+
+        return self.run(x, s)
+
+    def run(self, x, s, method='grouped', shared=False):
+        """Run by the `method` of 'grouped' or 'dense', the latter with the
+        style `shared` by all samples or not.
+        """
+        if method == 'dense':
+            return self._dense(x, s, shared)
+        elif method != 'grouped':
+            raise ValueError('method {} not supported'.format(method))
+
         eps = 1e-8
 
         N, Cin, *DHWin = x.shape
@@ -178,7 +200,10 @@ class ConvStyled3d(nn.Module):
         # print(N, Cin, *DHWin)
         x = x.reshape(1, N * Cin, *DHWin)
         # END HERE
-        x = self.conv(x, w, bias=self.bias, stride=self.stride, groups=N)
+        bias = self.bias
+        if bias is not None and N > 1:  # of every group
+            bias = bias.repeat(N)
+        x = self.conv(x, w, bias=bias, stride=self.stride, groups=N)
         _, _, *DHWout = x.shape
         # print('N', N, 'Cout', Cout, 'DHWout', *DHWout)
         # x = x.reshape(N, Cout, *DHWout)
@@ -187,6 +212,49 @@ class ConvStyled3d(nn.Module):
 
         return x
 
+    def _dense(self, x, s, shared):
+        eps = 1e-8
+
+        N = len(x)
+        C0, C1, *K3 = self.weight.shape
+
+        if self.resample == 'U':
+            Cin, Cout = C0, C1
+            s_shape, fan_in_dim = (Cin, 1, 1, 1, 1), (0, 2, 3, 4)
+        else:
+            Cout, Cin = C0, C1
+            s_shape, fan_in_dim = (1, Cin, 1, 1, 1), (1, 2, 3, 4)
+
+        if shared:
+            s = self.style_block(s[:1])
+            w = self.weight * s.reshape(s_shape)
+            w = w * torch.rsqrt(w.pow(2).sum(dim=fan_in_dim, keepdim=True)
+                                + eps)
+            w = w.contiguous(memory_format=suggest_memory_format(x))
+            return self.conv(x, w, bias=self.bias, stride=self.stride)
+
+        # modulate the input, convolve, and demodulate the output
+        s = self.style_block(s)
+        w2 = self.weight.pow(2).sum(dim=(2, 3, 4))
+        if self.resample != 'U':
+            w2 = w2.t()
+        d = torch.rsqrt(s.pow(2) @ w2 + eps)
+
+        x = x * s.reshape(N, Cin, 1, 1, 1)
+        x = self.conv(x, self.weight, stride=self.stride)
+        x = x * d.reshape(N, Cout, 1, 1, 1)
+        if self.bias is not None:
+            x = x + self.bias.reshape(1, Cout, 1, 1, 1)
+
+        return x
+
+
+def suggest_memory_format(x):
+    if x.dim() == 5 and x.is_contiguous(memory_format=torch.channels_last_3d) \
+            and not x.is_contiguous():
+        return torch.channels_last_3d
+    return torch.contiguous_format
+
 
 class BatchNormStyled3d(nn.BatchNorm3d):
     """ Trivially does standard batch normalization, but accepts second argument
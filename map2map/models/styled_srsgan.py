@@ -8,6 +8,7 @@ from .resample import Resampler, Resampler2
 from .style import ConvStyled3d, LeakyReLUStyled, LeakyReLUStyled2
 from .styled_conv import ResStyledBlock
 from .lag2eul import lag2eul
+from .noise import hash_noise, narrowed_origin
 
 
 class mySequential(nn.Sequential):
@@ -44,18 +45,28 @@ class G(nn.Module):
         for b in range(num_blocks):
             prev_chan, next_chan = chan(b), chan(b + 1)
             self.blocks.append(
-                HBlock(prev_chan, next_chan, out_chan, cat_noise, style_size))
-
-    def forward(self, x, style):
+                HBlock(prev_chan, next_chan, out_chan, cat_noise, style_size,
+                       noise_stream=2 * b))
+
+    def forward(self, x, style, origin=None, seed=0):
+        """With the global `origin` of the first input voxel of every sample,
+        the noise is hashed from the `seed` and the global voxel positions,
+        and thus the same in overlapping patches, see `AddNoise`.
+        """
         s = style
+        size = x.shape[2:]
         y = x  # direct upsampling from the input
 
         x = self.block0((x, s))
 
         # y = None  # no direct upsampling from the input
 
-        for block in self.blocks:
-            x, y, s = block(x, y, s)
+        for b, block in enumerate(self.blocks):
+            block_origin = None
+            if origin is not None:
+                block_origin = narrowed_origin(origin, size, x.shape[2:],
+                                               scale=2 ** b)
+            x, y, s = block(x, y, s, origin=block_origin, seed=seed)
         return y
 
 
@@ -86,14 +97,15 @@ class HBlock(nn.Module):
     next_size = 2 * prev_size - 6
     """
 
-    def __init__(self, prev_chan, next_chan, out_chan, cat_noise, style_size):
+    def __init__(self, prev_chan, next_chan, out_chan, cat_noise, style_size,
+                 noise_stream=0):
         super().__init__()
 
         self.upsample = Resampler(3, 2)
 
         # isolate conv style part to make input right
         self.noise_upsample = nn.Sequential(
-            AddNoise(cat_noise, chan=prev_chan),
+            AddNoise(cat_noise, chan=prev_chan, stream=noise_stream),
             self.upsample,
         )
 
@@ -101,7 +113,8 @@ class HBlock(nn.Module):
             ConvStyled3d(prev_chan + int(cat_noise), next_chan, style_size, 3),
             LeakyReLUStyled(0.2, True),
         )
-        self.addnoise = AddNoise(cat_noise, chan=next_chan) 
+        self.addnoise = AddNoise(cat_noise, chan=next_chan,
+                                 stream=noise_stream + 1)
         
         self.conv1 = nn.Sequential(
             ConvStyled3d(next_chan + int(cat_noise), next_chan, style_size, 3),
@@ -113,18 +126,26 @@ class HBlock(nn.Module):
             LeakyReLUStyled(0.2, True),
         )
 
-    def forward(self, x, y, s):
-        x = self.noise_upsample(x)
-        x = self.conv((x,s))
-        x = self.addnoise(x)
+    def forward(self, x, y, s, origin=None, seed=0):
+        if origin is None:
+            x = self.noise_upsample(x)
+            x = self.conv((x,s))
+            x = self.addnoise(x)
+        else:
+            size = x.shape[2:]
+            noise, upsample = self.noise_upsample
+            x = upsample(noise(x, origin=origin, seed=seed))
+            x = self.conv((x,s))
+            x = self.addnoise(x, origin=narrowed_origin(
+                origin, size, x.shape[2:], scale=2), seed=seed)
         x = self.conv1((x,s))
 
         if y is None:
             y = self.proj((x,s))
         else:
-            y = self.upsample(y)  
-
-            y = narrow_by(y, 2)
+            # narrow by 1 (upsampled by 2) beforehand to skip the voxels
+            # discarded afterwards
+            y = self.upsample(narrow_by(y, 1))
             y = y + self.proj((x,s))
         return x, y, s
 
@@ -135,18 +156,28 @@ class AddNoise(nn.Module):
     Add noise if `cat=False`.
     The number of channels `chan` should be 1 (StyleGAN2)
     or that of the input (StyleGAN).
+
+    By default the noise is drawn from the global RNG.
+    Given the global `origin` of the first voxel of every sample, it is
+    instead hashed from the `seed`, the `stream` of this layer, and the
+    global voxel positions by `hash_noise`, so that the overlapping patches,
+    e.g. of any tiling, see the same noise.
     """
 
-    def __init__(self, cat, chan=1):
+    def __init__(self, cat, chan=1, stream=0):
         super().__init__()
 
         self.cat = cat
+        self.stream = stream
 
         if not self.cat:
             self.std = nn.Parameter(torch.zeros([chan]))
 
-    def forward(self, x):
-        noise = torch.randn_like(x[:, :1])
+    def forward(self, x, origin=None, seed=0):
+        if origin is None:
+            noise = torch.randn_like(x[:, :1])
+        else:
+            noise = hash_noise(x, origin, seed=seed, stream=self.stream)
 
         if self.cat:
             x = torch.cat([x, noise], dim=1)
@@ -162,7 +193,11 @@ class AddNoise(nn.Module):
 class D(nn.Module):
     def __init__(self, in_chan, out_chan, style_size, scale_factor=8,
                  chan_base=512, chan_min=64, chan_max=512,
-                 **kwargs):
+                 eul_scale_factor=2, **kwargs):
+        """Styled discriminator of `in_chan` fields, prepended by the
+        Eulerian density of `lag2eul`, pixel-unshuffled from
+        `eul_scale_factor` times the size, see `train.adv_cat`.
+        """
         super().__init__()
 
         self.scale_factor = scale_factor
@@ -181,10 +216,10 @@ class D(nn.Module):
             return c
 
         self.block0 = nn.Sequential(
-            ConvStyled3d(in_chan + 8, chan(num_blocks), self.style_size, 1),
+            ConvStyled3d(in_chan + eul_scale_factor ** 3, chan(num_blocks),
+                         self.style_size, 1),
             LeakyReLUStyled(0.2, True),
         )
-        # FIXME here I hard coded the in_chan+8 to meet the dimension after mesh_up factor 2
 
         self.blocks = nn.ModuleList()
         for b in reversed(range(num_blocks)):
@@ -1,38 +1,122 @@
 import os
 import sys
+import inspect
 import warnings
+from glob import glob
 from pprint import pprint
 import numpy as np
 import torch
-from torch.utils.data import DataLoader
+from torch.multiprocessing import spawn
+from torch.utils.data import DataLoader, Subset
 
 from .data import FieldDataset
 from .data import norms
 from . import models
-from .models import narrow_cast
+from .models import narrow_cast, ConvTuner, set_conv_tuner
+from .models.export import freeze_style
 from .utils import import_attr, load_model_state_dict
+from .utils.tiling import plan_tiling, format_tiling
+from .utils.dist import set_cpu_threads, get_memory_format
+from .utils.report import SnapshotMetrics
+from .utils.jobs import JobQueue
+from .utils.infer import (PatchPool, HostRing, bench_patch_pool,
+                          format_patch_pool)
 
 
 def test(args):
-    if torch.cuda.is_available():
-        if torch.cuda.device_count() > 1:
-            warnings.warn('Not parallelized but given more than 1 GPUs')
+    """Inference on one process per GPU, or `--procs-per-node` processes on
+    CPUs, of every node (i.e. slurm task, e.g. by `srun`), or on those
+    launched by torchrun.
 
-        os.environ['CUDA_VISIBLE_DEVICES'] = '0'
+    The processes are independent, each assembling its own shard of the
+    snapshots or crops into the output fields, see `FieldDataset.shard`.
+    """
+    if 'LOCAL_RANK' in os.environ and 'GROUP_RANK' in os.environ:
+        # launched by torchrun, one process per GPU and nothing to spawn
+        args.procs_per_node = int(os.environ['LOCAL_WORLD_SIZE'])
+        args.world_size = int(os.environ['WORLD_SIZE'])
+
+        test_worker(int(os.environ['LOCAL_RANK']),
+                    int(os.environ['GROUP_RANK']), args)
+        return
+
+    nodes, node = 1, 0
+    if 'SLURM_STEP_NUM_TASKS' in os.environ:
+        nodes = int(os.environ['SLURM_STEP_NUM_TASKS'])
+        node = int(os.environ['SLURM_PROCID'])
+
+    if args.device != 'cpu' and torch.cuda.is_available():
+        args.procs_per_node = torch.cuda.device_count()
+    elif args.device == 'cuda':
+        raise RuntimeError('GPU not found on node {}'.format(node))
+    else:
+        args.device = 'cpu'
+
+    args.world_size = nodes * args.procs_per_node
+
+    if args.procs_per_node == 1:
+        test_worker(0, node, args)
+    else:
+        spawn(test_worker, args=(node, args), nprocs=args.procs_per_node)
+
+
+def test_worker(local_rank, node, args):
+    if args.device != 'cpu':
+        os.environ['CUDA_DEVICE_ORDER'] = 'PCI_BUS_ID'
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(local_rank)
+
+    pool = None
+    if args.device != 'cpu' and torch.cuda.is_available():
         device = torch.device('cuda', 0)
 
-        torch.backends.cudnn.benchmark = True
+        torch.backends.cudnn.benchmark = args.conv_tune is None
     else:  # CPU multithreading
         device = torch.device('cpu')
 
-        if args.num_threads is None:
-            args.num_threads = int(os.environ['SLURM_CPUS_ON_NODE'])
+        num_threads = set_cpu_threads(local_rank, args.procs_per_node,
+                                      loader_workers=args.loader_workers,
+                                      num_threads=args.num_threads,
+                                      pin=args.procs_per_node > 1)
 
-        torch.set_num_threads(args.num_threads)
+        pool = PatchPool(workers=args.cpu_workers,
+                         threads=max(num_threads // args.cpu_workers, 1),
+                         memory_format=get_memory_format(args),
+                         dtype=torch.bfloat16 if args.bf16 else None)
 
-    print('pytorch {}'.format(torch.__version__))
-    pprint(vars(args))
-    sys.stdout.flush()
+    rank = args.procs_per_node * node + local_rank
+
+    if args.tile_mem is not None:
+        size = np.load(sorted(glob(args.test_in_patterns[0]))[0],
+                       mmap_mode='r').shape[1:]
+        in_chan = sum(np.load(sorted(glob(p))[0], mmap_mode='r').shape[0]
+                      for p in args.test_in_patterns)
+        out_chan = sum(np.load(sorted(glob(p))[0], mmap_mode='r').shape[0]
+                       for p in args.test_tgt_patterns)
+        style_size = 0
+        if args.test_style_pattern is not None:
+            style_size = np.load(sorted(glob(args.test_style_pattern))[0]
+                                 ).shape[0]
+
+        with torch.device('meta'):
+            model = import_attr(args.model, models,
+                                callback_at=args.callback_at)
+            model = model(in_chan, out_chan, style_size=style_size,
+                          scale_factor=args.scale_factor, **args.misc_kwargs)
+        plan = plan_tiling(model, size, args.scale_factor,
+                           args.tile_mem * 2**30, in_chan,
+                           style_size=style_size, batch_size=args.batch_size)
+        del model
+
+        if rank == 0:
+            print('tiling plan:\n{}'.format(format_tiling(plan)))
+        args.crop, args.in_pad, args.crop_step = (
+            plan['crop'], plan['pad'], plan['step'])
+        args.tgt_pad = 0
+
+    if rank == 0:
+        print('pytorch {}'.format(torch.__version__))
+        pprint(vars(args))
+        sys.stdout.flush()
 
     test_dataset = FieldDataset(
         in_patterns=args.test_in_patterns,
@@ -54,13 +138,9 @@ def test(args):
         scale_factor=args.scale_factor,
         **args.misc_kwargs,
     )
-    test_loader = DataLoader(
-        test_dataset,
-        batch_size=args.batch_size,
-        shuffle=False,
-        num_workers=args.loader_workers,
-        pin_memory=True,
-    )
+    # with --resume, skip the crops already assembled, and continue the
+    # partial fields
+    test_dataset.assembly_resume = args.resume
 
     in_chan = test_dataset.in_chan
     out_chan = test_dataset.tgt_chan
@@ -70,6 +150,12 @@ def test(args):
     model = model(sum(in_chan), sum(out_chan), style_size=style_size,
                   scale_factor=args.scale_factor, **args.misc_kwargs)
     model.to(device)
+    # noise hashed from the global positions if supported, see `AddNoise`
+    args.noise_anchored = (
+        not args.noise_drawn
+        and 'origin' in inspect.signature(model.forward).parameters)
+    if args.conv_tune is not None:
+        set_conv_tuner(model, ConvTuner(args.conv_tune))
 
     criterion = import_attr(args.criterion, torch.nn, models,
                             callback_at=args.callback_at)
@@ -84,15 +170,139 @@ def test(args):
 
     model.eval()
 
+    frozen = {}  # models with frozen styles, by the latest styles
+
+    report = None
+    if args.report is not None:
+        report = SnapshotMetrics(test_dataset.nfile, out_chan, device,
+                                 eul=args.report_eul)
+
+    names = [os.path.relpath(files[0], start=test_dataset.commonpath)
+             for files in test_dataset.tgt_files]
+
+    if args.queue is None:
+        indices = test_dataset.shard(rank, args.world_size, by=args.shard_by)
+        print('rank {} with {} of {} samples'.format(
+            rank, len(indices), len(test_dataset)), flush=True)
+
+        pool = infer(indices, test_dataset, model, criterion, frozen, pool,
+                     report, device, args)
+    else:
+        queue = JobQueue(args.queue, names, max_tries=args.queue_tries,
+                         timeout=args.queue_timeout)
+        if args.queue_verify:
+            reset = queue.verify()
+            for name in reset:
+                test_dataset.reset_assembly('_out', names.index(name))
+            if len(reset) > 0:
+                print('rank {} reset modified outputs of {}'.format(
+                    rank, reset), flush=True)
+
+        # snapshots retried or reclaimed continue from their progress, and
+        # those already assembled are only recorded
+        test_dataset.assembly_resume = True
+
+        while True:
+            ifile = queue.claim()
+            if ifile is None:
+                break
+
+            indices = test_dataset.select([ifile])
+            print('rank {} claimed {} with {} samples left'.format(
+                rank, names[ifile], len(indices)), flush=True)
+
+            try:
+                pool = infer(indices, test_dataset, model, criterion, frozen,
+                             pool, report, device, args)
+            except Exception as e:
+                warnings.warn('{} failed: {!r}'.format(names[ifile], e))
+                queue.fail(ifile, repr(e))
+                test_dataset.assembly_line = {}
+                continue
+
+            queue.complete(ifile, test_dataset.assembly_paths('_out', ifile))
+
+        print('rank {} found no more snapshots in queue: {}'.format(
+            rank, queue.summary()), flush=True)
+
+    if report is not None:
+        path = args.report
+        if args.queue is not None:
+            suffix = '_' + queue.owner.replace(':', '_')
+            path = suffix.join(os.path.splitext(path))
+        elif args.world_size > 1:
+            path = '_rank{}'.format(rank).join(os.path.splitext(path))
+        report.write(path, names=names)
+        print('metrics of rank {} written to {}'.format(rank, path))
+
+    if pool is not None:
+        pool.close()
+
+
+def infer(indices, test_dataset, model, criterion, frozen, pool, report,
+          device, args):
+    """Run the model on the samples of `indices` and assemble the outputs.
+
+    Return the CPU `pool`, replaced by the fastest on the first batch with
+    --bench-cpu-workers.
+    """
+    test_loader = DataLoader(
+        Subset(test_dataset, indices),
+        batch_size=args.batch_size,
+        shuffle=False,
+        num_workers=args.loader_workers,
+        pin_memory=device.type == 'cuda',
+    )
+
+    tgt_norms = None
+    if args.tgt_norms is not None:
+        tgt_norms = [import_attr(norm, norms, callback_at=args.callback_at)
+                     for norm in test_dataset.tgt_norms]
+
+    ring = HostRing(device)
+
     with torch.no_grad():
         for i, data in enumerate(test_loader):
+            # otherwise drawn noise, deterministic given the batching,
+            # seeded by the index of the first sample in the batch
+            torch.manual_seed(args.seed + indices[i * args.batch_size])
+
             input, target, style = data['input'], data['target'], data['style']
 
             input = input.to(device, non_blocking=True)
             target = target.to(device, non_blocking=True)
             style = style.to(device, non_blocking=True)
 
-            output = model(input, style=style)
+            kwargs = {}
+            if args.noise_anchored:
+                # noise hashed from the global positions, tiling invariant,
+                # with a seed per snapshot
+                batch = indices[i * args.batch_size:(i + 1) * args.batch_size]
+                kwargs['origin'] = data['anchor'].to(device)
+                kwargs['seed'] = args.seed + torch.tensor(
+                    [idx // test_dataset.ncrop for idx in batch],
+                    device=device)
+
+            if args.freeze_style and (style == style[:1]).all():
+                key = tuple(style[0].tolist())
+                if key not in frozen:
+                    if len(frozen) >= 4:
+                        frozen.pop(next(iter(frozen)))
+                    example = input if args.trace_frozen else None
+                    frozen[key] = freeze_style(model, style[0],
+                                               example=example,
+                                               example_kwargs=kwargs)
+                net = frozen[key]
+            else:
+                net = model
+
+            if pool is None:
+                output = net(input, style=style, **kwargs)
+            else:
+                if args.bench_cpu_workers:
+                    pool = bench_pool(pool, net, input, style)
+                    args.bench_cpu_workers = False
+                output = pool(net, input, style=style, **kwargs)
             if i < 5:
                 print('##### sample :', i)
                 print('input shape :', input.shape)
@@ -100,31 +310,71 @@ def test(args):
                 print('target shape :', target.shape)
                 print('style shape :', style.shape)
 
-            input, output, target = narrow_cast(input, output, target)
+            if args.scale_factor == 1:
+                input, output, target = narrow_cast(input, output, target)
+            else:  # input is of lower resolution
+                output, target = narrow_cast(output, target)
             if i < 5:
                 print('narrowed shape :', output.shape, flush=True)
 
-            loss = criterion(output, target)
-
-            print('sample {} loss: {}'.format(i, loss.item()))
-
-            #if args.in_norms is not None:
-            #    start = 0
-            #    for norm, stop in zip(test_dataset.in_norms, np.cumsum(in_chan)):
-            #        norm = import_attr(norm, norms, callback_at=args.callback_at)
-            #        norm(input[:, start:stop], undo=True, **args.misc_kwargs)
-            #        start = stop
-            if args.tgt_norms is not None:
-                start = 0
-                for norm, stop in zip(test_dataset.tgt_norms, np.cumsum(out_chan)):
-                    norm = import_attr(norm, norms, callback_at=args.callback_at)
-                    norm(output[:, start:stop], undo=True, **args.misc_kwargs)
-                    #norm(target[:, start:stop], undo=True, **args.misc_kwargs)
-                    start = stop
-
-            #test_dataset.assemble('_in', in_chan, input,
-            #                      data['input_relpath'])
-            test_dataset.assemble('_out', out_chan, output,
-                                  data['target_relpath'])
-            #test_dataset.assemble('_tgt', out_chan, target,
-            #                      data['target_relpath'])
+            if report is not None:
+                batch = indices[i * args.batch_size:(i + 1) * args.batch_size]
+                report.update([idx // test_dataset.ncrop for idx in batch],
+                              output, target, style=data['style'])
+
+            if i < 5:
+                loss = criterion(output, target)
+                print('sample {} loss: {}'.format(i, loss.item()))
+
+            # un-normalized and written from host buffers, while the device
+            # moves on to the next batches
+            done = ring.push(output, data['target_relpath'])
+            if done is not None:
+                write_output(test_dataset, tgt_norms, *done, args)
+
+        for done in ring.drain():
+            write_output(test_dataset, tgt_norms, *done, args)
+
+    return pool
+
+
+def write_output(test_dataset, tgt_norms, output, paths, args):
+    """Un-normalize in place and assemble a batch of outputs on host.
+    """
+    out_chan = test_dataset.tgt_chan
+
+    #if args.in_norms is not None:
+    #    start = 0
+    #    for norm, stop in zip(test_dataset.in_norms, np.cumsum(in_chan)):
+    #        norm = import_attr(norm, norms, callback_at=args.callback_at)
+    #        norm(input[:, start:stop], undo=True, **args.misc_kwargs)
+    #        start = stop
+    if tgt_norms is not None:
+        start = 0
+        for norm, stop in zip(tgt_norms, np.cumsum(out_chan)):
+            norm(output[:, start:stop], undo=True, **args.misc_kwargs)
+            #norm(target[:, start:stop], undo=True, **args.misc_kwargs)
+            start = stop
+
+    #test_dataset.assemble('_in', in_chan, input,
+    #                      data['input_relpath'])
+    test_dataset.assemble('_out', out_chan, output, paths)
+    #test_dataset.assemble('_tgt', out_chan, target,
+    #                      data['target_relpath'])
+
+
+def bench_pool(pool, model, input, style):
+    """Benchmark all splits of the CPU threads of `pool` into workers, and
+    return a pool of the fastest.
+    """
+    results = bench_patch_pool(model, input, style,
+                               num_threads=pool.workers * pool.threads,
+                               memory_format=pool.memory_format,
+                               dtype=pool.dtype)
+    print(format_patch_pool(results), flush=True)
+
+    pool.close()
+
+    return PatchPool(workers=results[0]['workers'],
+                     threads=results[0]['threads'],
+                     memory_format=pool.memory_format, dtype=pool.dtype)
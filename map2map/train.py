@@ -1,53 +1,99 @@
 import os
 import socket
 import time
+import datetime
+import contextlib
 import sys
 from pprint import pprint
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.distributed as dist
 from torch.multiprocessing import spawn
-from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
-from torch.utils.tensorboard import SummaryWriter
 
 from .data import FieldDataset, DistFieldSampler
 from . import models
 from .models import (
-    narrow_cast, resample,lag2eul,
-    WDistLoss, wasserstein_distance_loss, wgan_grad_penalty,
-    grad_penalty_reg,
-    add_spectral_norm,
+    narrow_cast, resample,lag2eul, CropPool, CopyCounter,
+    WDistLoss, wasserstein_distance_loss,
+    grad_penalty_reg, GradPenalty,
+    add_spectral_norm, bench_spectral_norm, format_spectral_norm,
     InstanceNoise,
+    ConvTuner, set_conv_tuner,
 )
 from .utils import import_attr, load_model_state_dict, plt_slices, plt_power, score
+from .utils.metrics import MetricsWriter
+from .utils.dist import (
+    wrap_ddp, bench_ddp, format_bench, get_optimizer, optimizer_state_dict,
+    get_rendezvous, get_master_addr, get_master_port, find_free_port, tcp_store,
+    set_cpu_threads, get_memory_format, set_memory_format,
+)
 
 
 ckpt_link = 'checkpoint.pt'
 
 
 def node_worker(args):
-    if 'SLURM_STEP_NUM_NODES' in os.environ:
-        args.nodes = int(os.environ['SLURM_STEP_NUM_NODES'])
-    elif 'SLURM_JOB_NUM_NODES' in os.environ:
-        args.nodes = int(os.environ['SLURM_JOB_NUM_NODES'])
+    if args.rendezvous == 'auto':
+        args.rendezvous = get_rendezvous()
+
+    if args.rendezvous == 'env':
+        # launched by torchrun, one process per GPU and nothing to spawn
+        # torchrun restarts all processes on failure, who then resume from
+        # the latest checkpoint
+        args.procs_per_node = int(os.environ['LOCAL_WORLD_SIZE'])
+        args.world_size = int(os.environ['WORLD_SIZE'])
+        args.nodes = args.world_size // args.procs_per_node
+
+        node = int(os.environ['GROUP_RANK'])
+        local_rank = int(os.environ['LOCAL_RANK'])
+
+        if 'TORCHELASTIC_RESTART_COUNT' in os.environ:
+            print('elastic restart count', os.environ['TORCHELASTIC_RESTART_COUNT'])
+
+        gpu_worker(local_rank, node, args)
+        return
+
+    if args.rendezvous == 'local':
+        # single node without slurm
+        args.nodes = 1
+        node = 0
+
+        args.dist_addr = '127.0.0.1'
+        args.dist_port = find_free_port(args.dist_addr)
     else:
-        raise KeyError('missing node counts in slurm env')
-    args.gpus_per_node = torch.cuda.device_count()
-    args.world_size = args.nodes * args.gpus_per_node
+        if 'SLURM_STEP_NUM_NODES' in os.environ:
+            args.nodes = int(os.environ['SLURM_STEP_NUM_NODES'])
+        elif 'SLURM_JOB_NUM_NODES' in os.environ:
+            args.nodes = int(os.environ['SLURM_JOB_NUM_NODES'])
+        else:
+            raise KeyError('missing node counts in slurm env')
+
+        node = int(os.environ['SLURM_NODEID'])
 
-    node = int(os.environ['SLURM_NODEID'])
+        if args.rendezvous == 'tcp':
+            args.dist_addr = get_master_addr()
+            args.dist_port = get_master_port()
 
-    if args.gpus_per_node < 1:
+    # one process per GPU, or --procs-per-node processes on CPUs
+    gpus_per_node = 0
+    if args.device != 'cpu':
+        gpus_per_node = torch.cuda.device_count()
+    if gpus_per_node > 0:
+        args.procs_per_node = gpus_per_node
+    elif args.device == 'cuda':
         raise RuntimeError('GPU not found on node {}'.format(node))
+    else:
+        args.device = 'cpu'
+
+    args.world_size = args.nodes * args.procs_per_node
     
     print("method Node_worker in train.py")
     print("args",args)
     print("node",node)
-    print("gpus per node", args.gpus_per_node)  
-    spawn(gpu_worker, args=(node, args), nprocs=args.gpus_per_node)
+    print("procs per node", args.procs_per_node)
+    spawn(gpu_worker, args=(node, args), nprocs=args.procs_per_node)
     print("spawn successful")
 
 def gpu_worker(local_rank, node, args):
@@ -56,11 +102,24 @@ def gpu_worker(local_rank, node, args):
 	
     print("running gpu_worker in train.py")
 	
-    os.environ['CUDA_DEVICE_ORDER'] = 'PCI_BUS_ID'
-    os.environ['CUDA_VISIBLE_DEVICES'] = str(local_rank)
-    device = torch.device('cuda', 0)
+    if args.device != 'cpu':
+        os.environ['CUDA_DEVICE_ORDER'] = 'PCI_BUS_ID'
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(local_rank)
+
+    if args.device != 'cpu' and torch.cuda.is_available():
+        device = torch.device('cuda', 0)
+    elif args.device == 'cuda':
+        raise RuntimeError('GPU not found for local rank {}'.format(local_rank))
+    else:
+        device = torch.device('cpu')
+        args.dist_backend = 'gloo'
+
+        num_threads = set_cpu_threads(local_rank, args.procs_per_node,
+                                      loader_workers=args.loader_workers,
+                                      num_threads=args.num_threads)
+        print('local rank {} using {} threads'.format(local_rank, num_threads))
 
-    rank = args.gpus_per_node * node + local_rank
+    rank = args.procs_per_node * node + local_rank
 
     # Need randomness across processes, for sampler, augmentation, noise etc.
     # Note DDP broadcasts initial model states from rank 0
@@ -90,6 +149,7 @@ def gpu_worker(local_rank, node, args):
         in_pad=args.in_pad,
         tgt_pad=args.tgt_pad,
         scale_factor=args.scale_factor,
+        sample_files=args.sample_files or None,
         **args.misc_kwargs,
     )
     print("running DistFieldSampler in train.py")
@@ -104,7 +164,7 @@ def gpu_worker(local_rank, node, args):
         shuffle=False,
         sampler=train_sampler,
         num_workers=args.loader_workers,
-        pin_memory=True,
+        pin_memory=device.type == 'cuda',
     )
     print("args.val =",args.val)
     if args.val:
@@ -126,6 +186,7 @@ def gpu_worker(local_rank, node, args):
             in_pad=args.in_pad,
             tgt_pad=args.tgt_pad,
             scale_factor=args.scale_factor,
+            sample_files=args.sample_files or None,
             **args.misc_kwargs,
         )
         val_sampler = DistFieldSampler(val_dataset, shuffle=False,
@@ -137,7 +198,7 @@ def gpu_worker(local_rank, node, args):
             shuffle=False,
             sampler=val_sampler,
             num_workers=args.loader_workers,
-            pin_memory=True,
+            pin_memory=device.type == 'cuda',
         )
 
     args.in_chan = train_dataset.in_chan
@@ -149,9 +210,17 @@ def gpu_worker(local_rank, node, args):
     model = model(sum(args.in_chan), sum(args.out_chan), style_size=args.style_size,
                   scale_factor=args.scale_factor, **args.misc_kwargs)
     model.to(device)
+    set_memory_format(model, get_memory_format(args))
+    conv_tuner = None
+    if args.conv_tune is not None:
+        conv_tuner = ConvTuner(args.conv_tune)
+        set_conv_tuner(model, conv_tuner)
     print("running DistributedDataParallel in train.py")
-    model = DistributedDataParallel(model, device_ids=[device],
-                                    process_group=dist.new_group())
+    model = wrap_ddp(model, device,
+                     bucket_cap_mb=args.ddp_bucket_cap_mb,
+                     grad_as_bucket_view=args.ddp_grad_as_bucket_view,
+                     static_graph=args.ddp_static_graph,
+                     comm_hook=args.ddp_comm_hook)
 
     criterion = import_attr(args.criterion, nn, models,
                             callback_at=args.callback_at)
@@ -159,8 +228,10 @@ def gpu_worker(local_rank, node, args):
     criterion.to(device)
 
     optimizer = import_attr(args.optimizer, optim, callback_at=args.callback_at)
-    optimizer = optimizer(
+    optimizer = get_optimizer(
+        optimizer,
         model.parameters(),
+        zero=args.zero_optimizer,
         lr=args.lr,
         **args.optimizer_args,
     )
@@ -181,10 +252,16 @@ def gpu_worker(local_rank, node, args):
             **args.misc_kwargs,
         )
         if args.adv_model_spectral_norm:
-            add_spectral_norm(adv_model)
+            add_spectral_norm(adv_model,
+                              interval=args.adv_spectral_norm_interval)
         adv_model.to(device)
-        adv_model = DistributedDataParallel(adv_model, device_ids=[device],
-                                            process_group=dist.new_group())
+        set_memory_format(adv_model, get_memory_format(args))
+        set_conv_tuner(adv_model, conv_tuner)
+        # no static graph as requires_grad is toggled between D and G steps
+        adv_model = wrap_ddp(adv_model, device,
+                             bucket_cap_mb=args.adv_ddp_bucket_cap_mb,
+                             grad_as_bucket_view=args.ddp_grad_as_bucket_view,
+                             comm_hook=args.adv_ddp_comm_hook)
 
         adv_criterion = import_attr(args.adv_criterion, nn, models,
                                     callback_at=args.callback_at)
@@ -193,8 +270,10 @@ def gpu_worker(local_rank, node, args):
 
         adv_optimizer = import_attr(args.optimizer, optim,
                                     callback_at=args.callback_at)
-        adv_optimizer = adv_optimizer(
+        adv_optimizer = get_optimizer(
+            adv_optimizer,
             adv_model.parameters(),
+            zero=args.zero_optimizer,
             lr=args.adv_lr,
             **args.adv_optimizer_args,
         )
@@ -255,21 +334,30 @@ def gpu_worker(local_rank, node, args):
 
         del state
 
-    torch.backends.cudnn.benchmark = True
+    # off with the tuner, which decides per styled convolution
+    torch.backends.cudnn.benchmark = args.conv_tune is None
 
     if args.detect_anomaly:
         torch.autograd.set_detect_anomaly(True)
     
-    print("running SummaryWriter in train.py")
+    print("running MetricsWriter in train.py")
     logger = None
     if rank == 0:
-        logger = SummaryWriter()
+        logger = MetricsWriter(args.metrics,
+                               flush_secs=args.metrics_flush_secs,
+                               http_port=args.metrics_http_port)
 
     if rank == 0:
         print('pytorch {}'.format(torch.__version__))
         pprint(vars(args))
         sys.stdout.flush()
 
+    if args.bench_ddp or args.bench_spectral_norm:
+        train_sampler.set_epoch(start_epoch)
+        bench(train_loader, model, criterion, adv_model, device, args)
+        dist.destroy_process_group()
+        return
+
     if args.adv:
         args.instance_noise = InstanceNoise(args.instance_noise,
                                             args.instance_noise_batches)
@@ -295,6 +383,12 @@ def gpu_worker(local_rank, node, args):
             if args.adv:
                 adv_scheduler.step(epoch_loss[0])
 
+        # collective if optimizer states are sharded
+        optimizer_state = optimizer_state_dict(optimizer)
+        adv_optimizer_state = None
+        if args.adv:
+            adv_optimizer_state = optimizer_state_dict(adv_optimizer)
+
         if rank == 0:
             logger.flush()
 
@@ -305,7 +399,7 @@ def gpu_worker(local_rank, node, args):
             state = {
                 'epoch': epoch + 1,
                 'model': model.module.state_dict(),
-                'optimizer': optimizer.state_dict(),
+                'optimizer': optimizer_state,
                 'scheduler': scheduler.state_dict(),
                 'rng': torch.get_rng_state(),
                 'min_loss': min_loss,
@@ -313,18 +407,25 @@ def gpu_worker(local_rank, node, args):
             if args.adv:
                 state.update({
                     'adv_model': adv_model.module.state_dict(),
-                    'adv_optimizer': adv_optimizer.state_dict(),
+                    'adv_optimizer': adv_optimizer_state,
                     'adv_scheduler': adv_scheduler.state_dict(),
                 })
 
+            # save then rename, so that a failure (e.g. before an elastic
+            # restart) never leaves behind a truncated checkpoint
             state_file = 'state_{}.pt'.format(epoch + 1)
-            torch.save(state, state_file)
-            del state
+            tmp_state_file = '{}.tmp'.format(state_file)
+            torch.save(state, tmp_state_file)
+            os.rename(tmp_state_file, state_file)
+            del state, optimizer_state, adv_optimizer_state
 
             tmp_link = '{}.pt'.format(time.time())
             os.symlink(state_file, tmp_link)  # workaround to overwrite
             os.rename(tmp_link, ckpt_link)
 
+    if rank == 0:
+        logger.close()
+
     dist.destroy_process_group()
 
 
@@ -356,150 +457,242 @@ def train(epoch, loader, model, criterion, optimizer, scheduler,
     adv_real = torch.full([1], args.adv_label_smoothing, dtype=torch.float32,
             device=device)
 
+    memory_format = get_memory_format(args)
+
+    if args.adv:
+        grad_penalty = GradPenalty(args.adv_gp, gamma=args.adv_gp_gamma,
+                                   fraction=args.adv_gp_fraction,
+                                   patch_size=args.adv_gp_patch_size)
+
+    crops = CropPool()
+
     print("Loader_len: ",len(loader))
     for i, data in enumerate(loader):
         batch = epoch * len(loader) + i + 1
 
-        #BAYU 240117
-        print("Epoch: {}, Batch: {}".format(epoch,batch),flush=True)
-        #print("epoch : ", epoch)
-        #print("i : ",i)
-        #print("\n",flush=True)
-        #BAYU 240117
-        input, target, style = data['input'], data['target'], data['style']
-
-        #print(f"input = input.to(device, non_blocking=True), Device: {device}",flush=True)
-        input = input.to(device, non_blocking=True)
-        #print("target = target.to(device, non_blocking=True), Device: {device}",flush=True)        
-        target = target.to(device, non_blocking=True)
-        style = style.to(device, non_blocking=True)
+        copy_counter = CopyCounter() if args.debug_copies \
+            else contextlib.nullcontext()
+        with copy_counter:
+            #BAYU 240117
+            print("Epoch: {}, Batch: {}".format(epoch,batch),flush=True)
+            #print("epoch : ", epoch)
+            #print("i : ",i)
+            #print("\n",flush=True)
+            #BAYU 240117
+            input, target, style = data['input'], data['target'], data['style']
+
+            #print(f"input = input.to(device, non_blocking=True), Device: {device}",flush=True)
+            input = input.to(device, non_blocking=True,
+                             memory_format=memory_format)
+            #print("target = target.to(device, non_blocking=True), Device: {device}",flush=True)        
+            target = target.to(device, non_blocking=True)
+            style = style.to(device, non_blocking=True)
         
-        #print(input.shape, style.shape)
-        output = model(input, style)
-        #print("output = model(input, style)",flush=True)
-        if batch <= 5 and rank == 0:
-            print('##### batch :', batch)
-            print('input shape :', input.shape)
-            print('output shape :', output.shape)
-            print('target shape :', target.shape)
-            print('style shape :', style.shape)
-
-        if (hasattr(model.module, 'scale_factor')
-                and model.module.scale_factor != 1):
-            input = resample(input, model.module.scale_factor, narrow=False)
-        input, output, target = narrow_cast(input, output, target)
-        if batch <= 5 and rank == 0:
-            print('narrowed shape :', output.shape, flush=True)
-
-        loss = criterion(output, target)
-        # print('----- after trainin criterion -----')
-        # print(output.requires_grad, 'check require output gradient in training')
-        # print(target.requires_grad, 'check require target gradient in training')
-        epoch_loss[0] += loss.detach()
+            #print(input.shape, style.shape)
+            output = model(input, style)
+            #print("output = model(input, style)",flush=True)
+            if batch <= 5 and rank == 0:
+                print('##### batch :', batch)
+                print('input shape :', input.shape)
+                print('output shape :', output.shape)
+                print('target shape :', target.shape)
+                print('style shape :', style.shape)
 
-        if args.adv and epoch >= args.adv_start:
-            noise_std = args.instance_noise.std()
-            if noise_std > 0:
-                noise = noise_std * torch.randn_like(output)
-                output = output + noise
-                noise = noise_std * torch.randn_like(target)
-                target = target + noise
-                del noise
-
-            lag_out = output[:, :3]
-            eul_out = lag2eul(lag_out, a=np.float(style))[0]
-            lag_tgt = target[:, :3]
-            eul_tgt = lag2eul(lag_tgt, a=np.float(style))[0]
-            
-            output = torch.cat([eul_out, output], dim=1)
-            target = torch.cat([eul_tgt, target], dim=1)
-            
-            
-            if args.cgan:
-                output = torch.cat([input, output], dim=1)
-                target = torch.cat([input, target], dim=1)
-            # if output.requires_grad is not True:
-            #     output.requires_grad_(True)
-            # if target.requires_grad is not True:
-            #     target.requires_grad_(True)
-            # print('----- after set requires grad -----')
+            if (hasattr(model.module, 'scale_factor')
+                    and model.module.scale_factor != 1):
+                input = resample(input, model.module.scale_factor, narrow=False)
+            input, output, target = narrow_cast(input, output, target)
+            if batch <= 5 and rank == 0:
+                print('narrowed shape :', output.shape, flush=True)
+
+            loss = criterion(output, target)
+            # print('----- after trainin criterion -----')
             # print(output.requires_grad, 'check require output gradient in training')
             # print(target.requires_grad, 'check require target gradient in training')
-                
-            # check require grad
-            # assert target.requires_grad == True
-            # assert output.requires_grad == True
-            # discriminator
-            set_requires_grad(adv_model, True)
-
-            score_out = adv_model(output.detach(), style=style)
-            adv_loss_fake = adv_criterion(score_out, fake.expand_as(score_out))
-            epoch_loss[3] += adv_loss_fake.item()
-
-
-            adv_optimizer.zero_grad()
-            adv_loss_fake.backward()
-
-            score_tgt = adv_model(target, style=style)
-            adv_loss_real = adv_criterion(score_tgt, adv_real.expand_as(score_tgt))
-            epoch_loss[4] += adv_loss_real.item()
+            epoch_loss[0] += loss.detach()
 
+            if args.adv and epoch >= args.adv_start:
+                noise_std = args.instance_noise.std()
+                if noise_std > 0:
+                    noise = noise_std * torch.randn_like(output)
+                    output = output + noise
+                    noise = noise_std * torch.randn_like(target)
+                    target = target + noise
+                    del noise
+
+                output, target = adv_cat(input, output, target, style, args,
+                                         crops=crops)
+
+                # if output.requires_grad is not True:
+                #     output.requires_grad_(True)
+                # if target.requires_grad is not True:
+                #     target.requires_grad_(True)
+                # print('----- after set requires grad -----')
+                # print(output.requires_grad, 'check require output gradient in training')
+                # print(target.requires_grad, 'check require target gradient in training')
+                
+                # check require grad
+                # assert target.requires_grad == True
+                # assert output.requires_grad == True
+                # discriminator
+                set_requires_grad(adv_model, True)
+
+                # gradient penalty, lazy if not every batch, reusing the forward
+                # on the fake (R2) or real (R1) samples if on the whole batch
+                penalize = (args.adv_wgan_gp_interval > 0
+                            and batch % args.adv_wgan_gp_interval == 0)
+                reuse = grad_penalty.kind if penalize and grad_penalty.reuse \
+                    else None
+                grad_penalty.step_begin(device)
+
+                # generator adversarial loss on the fake scores of the
+                # discriminator before its update, i.e. simultaneous updates
+                g_step = batch % args.adv_iter_ratio == 0
+                reuse_fake = g_step and args.adv_reuse_fake
+                adv_params = None
+                if reuse_fake:
+                    adv_params = [p for p in adv_model.parameters()
+                                  if p.requires_grad]
+
+                if reuse_fake:
+                    fake_in = output
+                elif reuse == 'r2':
+                    fake_in = output.detach().requires_grad_(True)
+                else:
+                    fake_in = output.detach()
+                real_in = target
+                if reuse == 'r1':
+                    real_in = target.detach().requires_grad_(True)
+
+                score_gp = None
+                if args.adv_single_pass:
+                    # fake, real, and if possible the penalty samples in 1 batch
+                    adv_in, adv_style = [fake_in, real_in], [style, style]
+                    if penalize and reuse is None:
+                        gp_in, gp_style = grad_penalty.sample(output, target,
+                                                              style=style)
+                        if gp_in.shape[1:] == real_in.shape[1:]:
+                            adv_in.append(gp_in)
+                            adv_style.append(gp_style)
+                    scores = adv_model(crops.cat(adv_in, dim=0, key='adv'),
+                                       style=torch.cat(adv_style))
+                    score_out, score_tgt, *score_gp = torch.split(
+                        scores, [len(x) for x in adv_in])
+                    del scores
+                else:
+                    score_out = adv_model(fake_in, style=style)
 
-            adv_loss_real.backward()
+                adv_loss_fake = adv_criterion(score_out, fake.expand_as(score_out))
+                epoch_loss[3] += adv_loss_fake.detach()
 
-            adv_loss = adv_loss_fake + adv_loss_real
-            epoch_loss[2] += adv_loss.item()
+                if reuse_fake:
+                    loss_adv = adv_criterion(score_out, real.expand_as(score_out))
+                    epoch_loss[1] += args.adv_iter_ratio * loss_adv.detach()
+
+                    optimizer.zero_grad()
+                    loss_adv.backward(retain_graph=True,
+                                      inputs=list(model.parameters()))
+
+                adv_optimizer.zero_grad()
+                if reuse == 'r2':
+                    adv_loss_reg = grad_penalty.penalty(score_out, fake_in)
+                    adv_loss_fake_ = (adv_loss_fake
+                                      + adv_loss_reg * args.adv_wgan_gp_interval)
+                else:
+                    adv_loss_fake_ = adv_loss_fake
+                if not args.adv_single_pass:
+                    adv_loss_fake_.backward(inputs=adv_params)
+
+                    score_tgt = adv_model(real_in, style=style)
+                adv_loss_real = adv_criterion(score_tgt, adv_real.expand_as(score_tgt))
+                epoch_loss[4] += adv_loss_real.detach()
 
-            if (args.adv_wgan_gp_interval > 0
-                and  batch % args.adv_wgan_gp_interval == 0):
-                adv_loss_reg = wgan_grad_penalty(adv_model, output, target, style=style)
-                adv_loss_reg_ = adv_loss_reg * args.adv_wgan_gp_interval
+                if reuse == 'r1':
+                    adv_loss_reg = grad_penalty.penalty(score_tgt, real_in)
+                elif penalize and reuse is None:
+                    if score_gp:
+                        adv_loss_reg = grad_penalty.penalty(score_gp[0], gp_in)
+                    else:
+                        adv_loss_reg = grad_penalty(adv_model, output, target,
+                                                    style=style)
+                if penalize and reuse != 'r2':
+                    # in one backward with the real loss, so that DDP sees all
+                    # the parameters used
+                    adv_loss_real_ = (adv_loss_real
+                                      + adv_loss_reg * args.adv_wgan_gp_interval)
+                else:
+                    adv_loss_real_ = adv_loss_real
+                if args.adv_single_pass:
+                    (adv_loss_fake_ + adv_loss_real_).backward(inputs=adv_params)
+                else:
+                    adv_loss_real_.backward()
 
-                adv_loss_reg_.backward()
+                adv_loss = adv_loss_fake + adv_loss_real
+                epoch_loss[2] += adv_loss.detach()
 
-                if batch % adv_wgan_gp_log_interval == 0 and rank == 0:
+                if penalize and batch % adv_wgan_gp_log_interval == 0 \
+                        and rank == 0:
                     logger.add_scalar(
                         'loss/batch/train/adv/reg',
-                        adv_loss_reg.item(),
+                        adv_loss_reg,
                         global_step=batch,
                     )
 
-            adv_optimizer.step()
-            adv_grads = get_grads(adv_model)
-
-            # generator adversarial loss
-            if batch % args.adv_iter_ratio == 0:
-                set_requires_grad(adv_model, False)
+                adv_optimizer.step()
+                grad_penalty.step_end(penalize)
+                adv_grads = get_grads(adv_model)
 
-                score_out = adv_model(output, style=style)
-                loss_adv = adv_criterion(score_out, real.expand_as(score_out))
-                epoch_loss[1] += args.adv_iter_ratio * loss_adv.item()
+                if batch % adv_wgan_gp_log_interval == 0 and rank == 0:
+                    reg_time, reg_overhead = grad_penalty.cost()
+                    if reg_time is not None:
+                        logger.add_scalar('time/adv/reg', reg_time,
+                                          global_step=batch)
+                    if reg_overhead is not None:
+                        logger.add_scalar('time/adv/reg/overhead', reg_overhead,
+                                          global_step=batch)
 
+                # generator adversarial loss
+                if reuse_fake:
+                    optimizer.step()
+                    grads = get_grads(model)
+                elif g_step:
+                    set_requires_grad(adv_model, False)
+
+                    score_out = adv_model(output, style=style)
+                    loss_adv = adv_criterion(score_out, real.expand_as(score_out))
+                    epoch_loss[1] += args.adv_iter_ratio * loss_adv.detach()
+
+                    optimizer.zero_grad()
+                    loss_adv.backward()
+                    optimizer.step()
+                    grads = get_grads(model)
+            else:
                 optimizer.zero_grad()
-                loss_adv.backward()
+                loss.backward()
                 optimizer.step()
                 grads = get_grads(model)
-        else:
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-            grads = get_grads(model)
+
+        copies = crops.step()
+        if args.debug_copies:
+            copies += (copy_counter.copies, copy_counter.bytes)
 
         if batch % args.log_interval == 0:
-            dist.all_reduce(loss)
-            loss /= world_size
+            # reduced lazily, waited on and scaled by the metrics writer
+            loss = loss.detach()
+            work = dist.all_reduce(loss, async_op=True)
             if rank == 0:
-                logger.add_scalar('loss/batch/train', loss.item(),
-                                  global_step=batch)
+                logger.add_scalar('loss/batch/train', loss,
+                                  global_step=batch,
+                                  work=work, scale=1 / world_size)
                 if args.adv and epoch >= args.adv_start:
-                    logger.add_scalar('loss/batch/train/adv/G', loss_adv.item(),
+                    logger.add_scalar('loss/batch/train/adv/G', loss_adv,
                                       global_step=batch)
                     logger.add_scalars(
                         'loss/batch/train/adv/D',
                         {
-                            'total': adv_loss.item(),
-                            'fake': adv_loss_fake.item(),
-                            'real': adv_loss_real.item(),
+                            'total': adv_loss,
+                            'fake': adv_loss_fake,
+                            'real': adv_loss_real,
                         },
                         global_step=batch,
                     )
@@ -516,6 +709,18 @@ def train(epoch, loader, model, criterion, optimizer, scheduler,
                         logger.add_scalar('instance_noise', noise_std,
                                           global_step=batch)
 
+                if args.debug_copies:
+                    logger.add_scalars(
+                        'debug/copies',
+                        {'crops': copies[0], 'all': copies[2]},
+                        global_step=batch,
+                    )
+                    logger.add_scalars(
+                        'debug/copies/bytes',
+                        {'crops': copies[1], 'all': copies[3]},
+                        global_step=batch,
+                    )
+
     dist.all_reduce(epoch_loss)
     epoch_loss /= len(loader) * world_size
     if rank == 0:
@@ -624,11 +829,16 @@ def validate(epoch, loader, model, criterion, adv_model, adv_criterion,
     fake = torch.zeros([1], dtype=torch.float32, device=device)
     real = torch.ones([1], dtype=torch.float32, device=device)
 
+    memory_format = get_memory_format(args)
+
+    crops = CropPool()
+
     with torch.no_grad():
         for data in loader:
             input, target, style = data['input'], data['target'], data['style']
 
-            input = input.to(device, non_blocking=True)
+            input = input.to(device, non_blocking=True,
+                             memory_format=memory_format)
             target = target.to(device, non_blocking=True)
             style = style.to(device, non_blocking=True)
 
@@ -644,8 +854,8 @@ def validate(epoch, loader, model, criterion, adv_model, adv_criterion,
 
             if args.adv and epoch >= args.adv_start:
                 if args.cgan:
-                    output = torch.cat([input, output], dim=1)
-                    target = torch.cat([input, target], dim=1)
+                    output = crops.cat([input, output], key='fake')
+                    target = crops.cat([input, target], key='real')
 
                 # discriminator
                 score_out = adv_model(output, style=style)
@@ -713,37 +923,135 @@ def validate(epoch, loader, model, criterion, adv_model, adv_criterion,
     return epoch_loss
 
 
-def dist_init(rank, args):
-    dist_file = 'dist_addr'
+def adv_cat(input, output, target, style, args, crops=None):
+    """Prepend the Eulerian fields of the output and target displacements,
+    and also the input for conditional GAN, to form the adversary inputs.
 
-    if rank == 0:
-        addr = socket.gethostname()
+    The narrowed views are concatenated with a single copy each, into the
+    reused buffers of `crops` (a `CropPool`) if given and not requiring grad.
+    """
+    eul_out = lag2eul(output[:, :3], a=float(style))[0]
+    eul_tgt = lag2eul(target[:, :3], a=float(style))[0]
 
-        with socket.socket() as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind((addr, 0))
-            _, port = s.getsockname()
+    output = [eul_out, output]
+    target = [eul_tgt, target]
 
-        args.dist_addr = 'tcp://{}:{}'.format(addr, port)
+    if args.cgan:
+        output.insert(0, input)
+        target.insert(0, input)
 
-        with open(dist_file, mode='w') as f:
-            f.write(args.dist_addr)
-    else:
-        while not os.path.exists(dist_file):
-            time.sleep(1)
+    if crops is None:
+        crops = CropPool()
+    output = crops.cat(output, key='fake')
+    target = crops.cat(target, key='real')
 
-        with open(dist_file, mode='r') as f:
-            args.dist_addr = f.read()
+    return output, target
+
+
+def bench(loader, model, criterion, adv_model, device, args):
+    """Benchmark the allreduce overlap of the (adversary) model on the first
+    batch, for every DDP communication config, and/or the spectral norm
+    overhead of the adversary, then report on rank 0.
+    """
+    rank = dist.get_rank()
+
+    data = next(iter(loader))
+    input, target, style = data['input'], data['target'], data['style']
+    input = input.to(device, non_blocking=True)
+    target = target.to(device, non_blocking=True)
+    style = style.to(device, non_blocking=True)
+
+    def loss_fn(model):
+        output = model(input, style)
+        output, tgt = narrow_cast(output, target)
+        return criterion(output, tgt)
+
+    models = [('model', model.module, loss_fn)]
+
+    if args.adv:
+        with torch.no_grad():
+            output = model(input, style)
+            inp = input
+            if (hasattr(model.module, 'scale_factor')
+                    and model.module.scale_factor != 1):
+                inp = resample(input, model.module.scale_factor, narrow=False)
+            inp, output, tgt = narrow_cast(inp, output, target)
+            output, tgt = adv_cat(inp, output, tgt, style, args)
+
+        def adv_loss_fn(adv_model):
+            return adv_model(output, style=style).mean() \
+                    - adv_model(tgt, style=style).mean()
+
+        models.append(('adv_model', adv_model.module, adv_loss_fn))
+
+    if args.bench_spectral_norm and args.adv and rank == 0:
+        results = bench_spectral_norm(adv_model.module, tgt, style=style)
+        print('spectral norm overhead of adv_model:')
+        print(format_spectral_norm(results), flush=True)
+
+    if not args.bench_ddp:
+        return
+
+    for name, module, fn in models:
+        results = bench_ddp(module, fn, device,
+                            bucket_caps=args.bench_ddp_bucket_caps,
+                            grad_as_bucket_view=args.ddp_grad_as_bucket_view)
+        if rank == 0:
+            print('allreduce overlap of {}:'.format(name))
+            print(format_bench(results), flush=True)
+
+
+def dist_init(rank, args):
+    timeout = datetime.timedelta(seconds=args.dist_timeout)
+
+    if args.rendezvous == 'env':
+        dist.init_process_group(
+            backend=args.dist_backend,
+            init_method='env://',
+            world_size=args.world_size,
+            rank=rank,
+            timeout=timeout,
+        )
+    elif args.rendezvous in ['tcp', 'local']:
+        store = tcp_store(args.dist_addr, args.dist_port, args.world_size,
+                          rank == 0, timeout, retries=args.dist_retries)
+
+        dist.init_process_group(
+            backend=args.dist_backend,
+            store=store,
+            world_size=args.world_size,
+            rank=rank,
+            timeout=timeout,
+        )
+    else:  # file, deprecated
+        dist_file = 'dist_addr'
+
+        if rank == 0:
+            addr = socket.gethostname()
+            port = find_free_port(addr)
+
+            args.dist_addr = 'tcp://{}:{}'.format(addr, port)
+
+            with open(dist_file, mode='w') as f:
+                f.write(args.dist_addr)
+        else:
+            while not os.path.exists(dist_file):
+                time.sleep(1)
+
+            with open(dist_file, mode='r') as f:
+                args.dist_addr = f.read()
+
+        dist.init_process_group(
+            backend=args.dist_backend,
+            init_method=args.dist_addr,
+            world_size=args.world_size,
+            rank=rank,
+            timeout=timeout,
+        )
 
-    dist.init_process_group(
-        backend=args.dist_backend,
-        init_method=args.dist_addr,
-        world_size=args.world_size,
-        rank=rank,
-    )
     dist.barrier()
 
-    if rank == 0:
+    if args.rendezvous == 'file' and rank == 0:
         os.remove(dist_file)
 
 
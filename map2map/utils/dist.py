@@ -0,0 +1,466 @@
+import os
+import copy
+import socket
+import subprocess
+import time
+import warnings
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+
+def get_comm_hook(name):
+    """Get a DDP gradient compression hook by name: None, 'fp16', or 'bf16'.
+    """
+    if name is None or name == 'none':
+        return None
+
+    from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+
+    hooks = {
+        'fp16': default_hooks.fp16_compress_hook,
+        'bf16': getattr(default_hooks, 'bf16_compress_hook', None),
+    }
+    if name not in hooks:
+        raise ValueError('comm hook {} not supported'.format(name))
+    if hooks[name] is None:
+        raise RuntimeError('comm hook {} needs a newer pytorch'.format(name))
+
+    return hooks[name]
+
+
+def wrap_ddp(module, device, bucket_cap_mb=25, grad_as_bucket_view=False,
+             static_graph=False, comm_hook=None, process_group=None):
+    """Wrap a module in DDP with its own process group, or `process_group` if
+    given.
+
+    `bucket_cap_mb` sets the gradient bucket size, smaller buckets start the
+    allreduce earlier in the backward pass and overlap more of it with the
+    computation, at the cost of more launches.
+    `grad_as_bucket_view` makes the gradients views into the buckets, saving
+    a copy and the memory of the gradients.
+    `static_graph` lets DDP skip the per-iteration search for used parameters,
+    only valid if the set of parameters with gradients is the same every
+    iteration.
+    `comm_hook` compresses the gradients to 'fp16' or 'bf16' for the
+    allreduce, halving the communication volume.
+    """
+    if process_group is None:
+        process_group = dist.new_group()
+
+    kwargs = {}
+    if static_graph:  # keyword only available in newer pytorch
+        kwargs['static_graph'] = True
+
+    module = DistributedDataParallel(
+        module,
+        device_ids=[device] if device.type == 'cuda' else None,
+        process_group=process_group,
+        bucket_cap_mb=bucket_cap_mb,
+        gradient_as_bucket_view=grad_as_bucket_view,
+        **kwargs,
+    )
+
+    comm_hook = get_comm_hook(comm_hook)
+    if comm_hook is not None:
+        module.register_comm_hook(process_group, comm_hook)
+
+    return module
+
+
+def bench_ddp(module, loss_fn, device, bucket_caps=(5, 25, 100),
+              comm_hooks=(None, 'fp16', 'bf16'), grad_as_bucket_view=False,
+              steps=10, warmup=2):
+    """Benchmark the overlap between gradient allreduce and backward pass.
+
+    `loss_fn` takes the DDP wrapped `module` and returns a scalar loss.
+    Every combination of `bucket_caps` and `comm_hooks` is timed for the
+    backward pass with gradient synchronization (`total`), without it
+    (`comp`), and for a bare allreduce of all gradients (`comm`).
+    The overlap is the fraction of the communication hidden behind the
+    computation, `(comp + comm - total) / comm`.
+
+    The configs are timed on a copy of `module`, free of the hooks of any
+    live DDP wrapper, sharing a single process group destroyed at the end.
+
+    Must be called by all ranks. Return a list of dicts, one per config.
+    """
+    module = copy.deepcopy(module)
+    group = dist.new_group()
+
+    def sync():
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        dist.barrier(group=group)
+
+    def time_backward(model, no_sync):
+        times = []
+        for step in range(warmup + steps):
+            model.zero_grad(set_to_none=True)
+            loss = loss_fn(model)
+            sync()
+
+            tic = time.perf_counter()
+            if no_sync:
+                with model.no_sync():
+                    loss.backward()
+            else:
+                loss.backward()
+            sync()
+            toc = time.perf_counter()
+
+            if step >= warmup:
+                times.append(toc - tic)
+        return sum(times) / len(times)
+
+    def time_allreduce(dtype):
+        grads = [p.grad for p in module.parameters() if p.grad is not None]
+        flat = torch.cat([g.flatten() for g in grads]).to(dtype)
+        times = []
+        for step in range(warmup + steps):
+            sync()
+            tic = time.perf_counter()
+            dist.all_reduce(flat, group=group)
+            sync()
+            toc = time.perf_counter()
+
+            if step >= warmup:
+                times.append(toc - tic)
+        return sum(times) / len(times)
+
+    comm_dtypes = {None: torch.float32, 'none': torch.float32,
+                   'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+    results = []
+    for bucket_cap_mb in bucket_caps:
+        for comm_hook in comm_hooks:
+            try:
+                get_comm_hook(comm_hook)
+            except RuntimeError:
+                continue
+
+            model = wrap_ddp(module, device, bucket_cap_mb=bucket_cap_mb,
+                             grad_as_bucket_view=grad_as_bucket_view,
+                             comm_hook=comm_hook, process_group=group)
+
+            comp = time_backward(model, no_sync=True)
+            total = time_backward(model, no_sync=False)
+            comm = time_allreduce(comm_dtypes[comm_hook])
+
+            overlap = (comp + comm - total) / comm if comm > 0 else 1.
+            overlap = min(max(overlap, 0.), 1.)
+
+            results.append({
+                'bucket_cap_mb': bucket_cap_mb,
+                'comm_hook': comm_hook or 'none',
+                'comp': comp,
+                'comm': comm,
+                'total': total,
+                'overlap': overlap,
+            })
+
+            module.zero_grad(set_to_none=True)
+            del model
+
+    dist.destroy_process_group(group)
+
+    return results
+
+
+def format_bench(results):
+    """Format the benchmark results from `bench_ddp` as a table.
+    """
+    lines = ['{:>14} {:>9} {:>10} {:>10} {:>10} {:>8}'.format(
+        'bucket_cap_mb', 'comm_hook', 'comp [s]', 'comm [s]', 'total [s]',
+        'overlap')]
+    for r in results:
+        lines.append('{:>14} {:>9} {:>10.4g} {:>10.4g} {:>10.4g} {:>8.1%}'.format(
+            r['bucket_cap_mb'], r['comm_hook'], r['comp'], r['comm'],
+            r['total'], r['overlap']))
+    return '\n'.join(lines)
+
+
+def get_optimizer(optimizer, params, zero=False, **kwargs):
+    """Instantiate `optimizer` class on `params`.
+
+    If `zero`, the optimizer states are sharded across the ranks with
+    `ZeroRedundancyOptimizer`, ZeRO stage 1, each rank only keeping the states
+    of its partition of the parameters.
+    """
+    if zero:
+        from torch.distributed.optim import ZeroRedundancyOptimizer
+
+        return ZeroRedundancyOptimizer(params, optimizer_class=optimizer,
+                                       **kwargs)
+
+    return optimizer(params, **kwargs)
+
+
+def optimizer_state_dict(optimizer, to=0):
+    """Return the full state dict of the optimizer.
+
+    Sharded optimizer states are consolidated on rank `to` first, in the same
+    layout as a unsharded optimizer, so checkpoints are interchangeable.
+    This is collective for sharded optimizer and must be called by all ranks,
+    with None returned on all but rank `to`.
+    """
+    if hasattr(optimizer, 'consolidate_state_dict'):
+        optimizer.consolidate_state_dict(to=to)
+
+        if dist.get_rank() != to:
+            return None
+
+    return optimizer.state_dict()
+
+
+def get_rendezvous():
+    """Detect the rendezvous method from the environment.
+
+    'env' if launched by torchrun (or with its env vars set),
+    'tcp' if under slurm, and 'local' otherwise.
+    """
+    if all(k in os.environ for k in ['RANK', 'WORLD_SIZE', 'LOCAL_RANK',
+                                     'MASTER_ADDR', 'MASTER_PORT']):
+        return 'env'
+    elif 'SLURM_NODEID' in os.environ:
+        return 'tcp'
+    else:
+        return 'local'
+
+
+def get_master_addr():
+    """Address of the rank 0 host, from MASTER_ADDR or else the first node of
+    the slurm job.
+    """
+    if 'MASTER_ADDR' in os.environ:
+        return os.environ['MASTER_ADDR']
+
+    if 'SLURM_JOB_NODELIST' in os.environ:
+        try:
+            hosts = subprocess.run(
+                ['scontrol', 'show', 'hostnames',
+                 os.environ['SLURM_JOB_NODELIST']],
+                stdout=subprocess.PIPE, check=True, universal_newlines=True,
+            ).stdout.split()
+            return hosts[0]
+        except (OSError, subprocess.CalledProcessError, IndexError):
+            pass
+
+    if 'SLURM_LAUNCH_NODE_IPADDR' in os.environ:
+        return os.environ['SLURM_LAUNCH_NODE_IPADDR']
+
+    raise KeyError('cannot find master address, set MASTER_ADDR')
+
+
+def get_master_port():
+    """Port of the rank 0 host, from MASTER_PORT or else derived from the
+    slurm job id so that concurrent jobs on the same node do not collide.
+    """
+    if 'MASTER_PORT' in os.environ:
+        return int(os.environ['MASTER_PORT'])
+
+    if 'SLURM_JOB_ID' in os.environ:
+        return 20000 + int(os.environ['SLURM_JOB_ID']) % 20000
+
+    raise KeyError('cannot find master port, set MASTER_PORT')
+
+
+def find_free_port(addr='127.0.0.1'):
+    with socket.socket() as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((addr, 0))
+        _, port = s.getsockname()
+    return port
+
+
+def tcp_store(addr, port, world_size, is_master, timeout, retries=5):
+    """Connect to (or host if `is_master`) the TCPStore for rendezvous.
+
+    Each attempt waits up to `timeout`, and failed attempts are retried
+    `retries` times with exponential backoff, e.g. when the master is late or
+    its port is still held by a previous run after an elastic restart.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return dist.TCPStore(addr, port, world_size, is_master,
+                                 timeout=timeout)
+        except (RuntimeError, OSError) as e:
+            if attempt == retries:
+                raise
+            warnings.warn('TCPStore at {}:{} attempt {} failed: {}'.format(
+                addr, port, attempt, e))
+            time.sleep(min(2 ** attempt, 60))
+
+
+def get_cpus():
+    """CPUs available to this process, e.g. those allocated by slurm.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def set_cpu_threads(local_rank, procs_per_node, loader_workers=0,
+                    num_threads=None, pin=True):
+    """Split the CPUs among the processes on a node to avoid oversubscription.
+
+    Each process gets a contiguous block of the available CPUs, to which it is
+    pinned if `pin` (inherited by its data loader workers), so processes do
+    not migrate onto each other's cores.
+    The intra-op threads default to the block size minus the `loader_workers`
+    that share the block, and at least 1.
+
+    Return the number of intra-op threads.
+    """
+    cpus = get_cpus()
+    block = max(len(cpus) // procs_per_node, 1)
+    start = local_rank * block % len(cpus)
+    block_cpus = cpus[start:start + block]
+
+    if pin and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, block_cpus)
+
+    if num_threads is None:
+        num_threads = max(len(block_cpus) - loader_workers, 1)
+    torch.set_num_threads(num_threads)
+
+    return num_threads
+
+
+def get_memory_format(args):
+    """Memory format of 3D inputs.
+
+    channels_last_3d (NDHWC) is generally faster for the oneDNN convolutions
+    on CPUs, and for tensor cores on GPUs in lower precision.
+    """
+    if getattr(args, 'channels_last', False):
+        return torch.channels_last_3d
+    return torch.preserve_format
+
+
+def set_memory_format(module, memory_format):
+    """Convert the weights of the plain 3D (transposed) convolutions in place.
+
+    Styled convolutions are left alone, as their weights are modulated into
+    new tensors at every call anyway.
+    """
+    if memory_format == torch.preserve_format:
+        return module
+
+    for m in module.modules():
+        if isinstance(m, (torch.nn.Conv3d, torch.nn.ConvTranspose3d)):
+            m.to(memory_format=memory_format)
+
+    return module
+
+
+def bench_scaling(model, in_chan, out_chan, style_size=0, size=32,
+                  batch_size=1, scale_factor=1, procs=(1, 2, 4),
+                  loader_workers=0, channels_last=False, steps=10, warmup=2,
+                  **kwargs):
+    """Benchmark the scaling efficiency of CPU training over gloo.
+
+    For each number of processes in `procs` on this node, train the `model`
+    (name in `map2map.models`) with DDP on random inputs of `size` (with
+    padding) and `batch_size` per process, with the CPU threads split among
+    the processes as in training.
+    The efficiency is the throughput relative to that of perfect scaling from
+    the smallest number of processes.
+
+    Return a list of dicts, one per number of processes.
+    """
+    from torch.multiprocessing import get_context, spawn
+
+    ctx = get_context('spawn')
+
+    results = []
+    for nprocs in procs:
+        queue = ctx.SimpleQueue()
+        port = find_free_port()
+        spawn(
+            _bench_scaling_worker,
+            args=(nprocs, port, queue, model, in_chan, out_chan, style_size,
+                  size, batch_size, scale_factor, loader_workers,
+                  channels_last, steps, warmup, kwargs),
+            nprocs=nprocs,
+        )
+        step_time, num_threads = queue.get()
+
+        results.append({
+            'procs': nprocs,
+            'threads': num_threads,
+            'step': step_time,
+            'throughput': nprocs * batch_size / step_time,
+        })
+
+    base = results[0]['throughput'] / results[0]['procs']
+    for r in results:
+        r['efficiency'] = r['throughput'] / (r['procs'] * base)
+
+    return results
+
+
+def _bench_scaling_worker(rank, world_size, port, queue, model, in_chan,
+                          out_chan, style_size, size, batch_size, scale_factor,
+                          loader_workers, channels_last, steps, warmup,
+                          kwargs):
+    from .. import models
+    from ..models import narrow_cast
+    from .imp import import_attr
+
+    num_threads = set_cpu_threads(rank, world_size,
+                                  loader_workers=loader_workers)
+
+    store = dist.TCPStore('127.0.0.1', port, world_size, rank == 0)
+    dist.init_process_group('gloo', store=store, world_size=world_size,
+                            rank=rank)
+
+    memory_format = (torch.channels_last_3d if channels_last
+                     else torch.preserve_format)
+
+    model = import_attr(model, models)
+    model = model(in_chan, out_chan, style_size=style_size,
+                  scale_factor=scale_factor, **kwargs)
+    set_memory_format(model, memory_format)
+    model = wrap_ddp(model, torch.device('cpu'))
+    optimizer = torch.optim.Adam(model.parameters())
+
+    input = torch.randn(batch_size, in_chan, *(size,) * 3)
+    input = input.contiguous(memory_format=memory_format)
+    target = torch.randn(batch_size, out_chan, *(size * scale_factor,) * 3)
+    style = torch.rand(batch_size, style_size)
+
+    times = []
+    for step in range(warmup + steps):
+        dist.barrier()
+        tic = time.perf_counter()
+
+        output = model(input, style) if style_size > 0 else model(input)
+        output, tgt = narrow_cast(output, target)
+        loss = (output - tgt).square().mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        dist.barrier()
+        toc = time.perf_counter()
+
+        if step >= warmup:
+            times.append(toc - tic)
+
+    if rank == 0:
+        queue.put((sum(times) / len(times), num_threads))
+
+    dist.destroy_process_group()
+
+
+def format_scaling(results):
+    """Format the benchmark results from `bench_scaling` as a table.
+    """
+    lines = ['{:>6} {:>8} {:>10} {:>12} {:>11}'.format(
+        'procs', 'threads', 'step [s]', 'samples/s', 'efficiency')]
+    for r in results:
+        lines.append('{:>6} {:>8} {:>10.4g} {:>12.4g} {:>11.1%}'.format(
+            r['procs'], r['threads'], r['step'], r['throughput'],
+            r['efficiency']))
+    return '\n'.join(lines)
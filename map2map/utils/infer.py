@@ -0,0 +1,209 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+from .dist import get_cpus
+
+
+class PatchPool:
+    """Run models on CPUs over several patches concurrently, in a pool of
+    `workers` threads with `threads` intra-op threads each.
+
+    Intra-op parallelism scales poorly on small 3D crops, so it is often
+    faster to split the CPUs among patches (inter-op parallelism).
+    A batch is split into `workers` chunks, whose outputs are concatenated.
+    The ops release the GIL, so the threads run in parallel.
+
+    `memory_format` (e.g. `torch.channels_last_3d`) is applied to the inputs,
+    which oneDNN convolutions prefer, and `dtype` (e.g. `torch.bfloat16`) to
+    autocast the convolutions on CPUs supporting it.
+
+    Note that the noise draws of concurrent threads interleave in the global
+    RNG, so with more than 1 worker the outputs are not reproducible, unless
+    hashed from the positions, e.g. with the `origin` passed as a keyword
+    argument.
+    Keyword tensors of the model are split along the batch like the input.
+    """
+    def __init__(self, workers=1, threads=None,
+                 memory_format=torch.preserve_format, dtype=None):
+        if threads is None:
+            threads = max(len(get_cpus()) // workers, 1)
+
+        self.workers = workers
+        self.threads = threads
+        self.memory_format = memory_format
+        self.dtype = dtype
+
+        self.executor = None
+        if workers > 1:
+            self.executor = ThreadPoolExecutor(
+                max_workers=workers, initializer=torch.set_num_threads,
+                initargs=(threads,))
+        else:
+            torch.set_num_threads(threads)
+
+    def __call__(self, model, input, style=None, **kwargs):
+        if self.executor is None:
+            return self._run(model, input, style, **kwargs)
+
+        inputs = torch.tensor_split(input, self.workers)
+        styles = torch.tensor_split(style, self.workers)
+        kwargs = {k: torch.tensor_split(v, self.workers)
+                  for k, v in kwargs.items()}
+        chunks = [(x, s, {k: v[i] for k, v in kwargs.items()})
+                  for i, (x, s) in enumerate(zip(inputs, styles))
+                  if len(x) > 0]
+
+        outputs = self.executor.map(
+            lambda chunk: self._run(model, chunk[0], chunk[1], **chunk[2]),
+            chunks)
+
+        return torch.cat(list(outputs))
+
+    def _run(self, model, input, style, **kwargs):
+        input = input.contiguous(memory_format=self.memory_format)
+
+        with torch.no_grad(), torch.autocast(
+                'cpu', dtype=self.dtype, enabled=self.dtype is not None):
+            output = model(input, style=style, **kwargs)
+
+        return output.float()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+class HostRing:
+    """Ring of `size` reusable host buffers receiving device outputs, e.g.
+    to be un-normalized in place and written by `FieldDataset.assemble`.
+
+    On GPUs the buffers are pinned and the copies are asynchronous on a side
+    stream, overlapping with the compute of the following batches.
+    `push` returns the oldest output once all buffers are in flight, after
+    its copy is done; it must be consumed before the next `push`, which
+    overwrites its buffer.
+    The buffers are allocated at the first batch, and a smaller (e.g. last)
+    batch reuses a leading slice of them.
+
+    On CPUs the outputs are already on host, and are passed through.
+    """
+    def __init__(self, device, size=2):
+        if size < 2:
+            raise ValueError('need at least 2 buffers to overlap copies')
+
+        self.device = torch.device(device)
+        self.size = size
+
+        self.buffers = [None] * size
+        self.next = 0
+        self.pending = deque()
+
+        self.stream = None
+        if self.device.type == 'cuda':
+            self.stream = torch.cuda.Stream(self.device)
+
+    def push(self, tensor, *args):
+        """Copy `tensor` to the next buffer, and return the oldest pending
+        `(buffer, *args)` once the ring is full, otherwise None.
+        """
+        if self.stream is None:
+            self.pending.append((tensor, None, args))
+        else:
+            buf = self._buffer(tensor)
+
+            self.stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.cuda.stream(self.stream):
+                buf.copy_(tensor, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record(self.stream)
+            tensor.record_stream(self.stream)
+
+            self.pending.append((buf, event, args))
+
+        if len(self.pending) == self.size:
+            return self.pop()
+        return None
+
+    def pop(self):
+        """Wait for and return the oldest pending `(buffer, *args)`.
+        """
+        buf, event, args = self.pending.popleft()
+        if event is not None:
+            event.synchronize()
+        return (buf, *args)
+
+    def drain(self):
+        """Yield all pending `(buffer, *args)`, oldest first.
+        """
+        while self.pending:
+            yield self.pop()
+
+    def _buffer(self, tensor):
+        i = self.next
+        self.next = (i + 1) % self.size
+
+        buf = self.buffers[i]
+        if (buf is None or buf.dtype != tensor.dtype
+                or buf.shape[1:] != tensor.shape[1:]
+                or len(buf) < len(tensor)):
+            buf = torch.empty(tensor.shape, dtype=tensor.dtype,
+                              pin_memory=True)
+            self.buffers[i] = buf
+
+        return buf[:len(tensor)]
+
+
+def bench_patch_pool(model, input, style, num_threads=None, splits=None,
+                     steps=5, warmup=1, **kwargs):
+    """Benchmark `PatchPool` throughput on a batch of `input` for every split
+    of `num_threads` (default to the available CPUs) into workers x threads,
+    in `splits` of (workers, threads) pairs, by default all with at most 1
+    worker per sample.
+
+    `kwargs` are passed to `PatchPool`, e.g. `memory_format`.
+
+    Return a list of dicts, the fastest first.
+    """
+    if num_threads is None:
+        num_threads = len(get_cpus())
+    if splits is None:
+        splits = [(w, num_threads // w) for w in range(1, num_threads + 1)
+                  if num_threads % w == 0 and w <= len(input)]
+
+    results = []
+    for workers, threads in splits:
+        pool = PatchPool(workers=workers, threads=threads, **kwargs)
+
+        for _ in range(warmup):
+            pool(model, input, style)
+
+        tic = time.perf_counter()
+        for _ in range(steps):
+            pool(model, input, style)
+        step_time = (time.perf_counter() - tic) / steps
+
+        pool.close()
+
+        results.append({
+            'workers': workers,
+            'threads': threads,
+            'step': step_time,
+            'throughput': len(input) / step_time,
+        })
+
+    results.sort(key=lambda r: r['throughput'], reverse=True)
+
+    return results
+
+
+def format_patch_pool(results):
+    """Format the benchmark results from `bench_patch_pool` as a table.
+    """
+    lines = ['{:>8} {:>8} {:>10} {:>12}'.format(
+        'workers', 'threads', 'step [s]', 'samples/s')]
+    for r in results:
+        lines.append('{:>8} {:>8} {:>10.4g} {:>12.4g}'.format(
+            r['workers'], r['threads'], r['step'], r['throughput']))
+    return '\n'.join(lines)
@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import fcntl
+import socket
+import hashlib
+from contextlib import contextmanager
+
+
+class JobQueue:
+    """Work queue of snapshots shared by concurrent processes, e.g. multiple
+    `m2m.py test` jobs over a simulation suite, through a JSON manifest
+    guarded by a file lock.
+
+    The manifest records for each job (named by `names`) its status
+    ('pending', 'running', 'done', or 'failed'), the owner process, the
+    number of tries, the last error, and the checksums of the outputs when
+    done.
+    A running job is reclaimed if its owner on the same host is dead, or if
+    claimed more than `timeout` seconds ago.
+    A failed job is retried until `max_tries`.
+
+    Note that `fcntl` locks may not work on some network file systems.
+    """
+    def __init__(self, path, names, max_tries=3, timeout=None):
+        self.path = path
+        self.names = list(names)
+        self.max_tries = max_tries
+        self.timeout = timeout
+        self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        with self._manifest() as jobs:
+            for name in self.names:
+                jobs.setdefault(name, {'status': 'pending', 'tries': 0})
+
+    def claim(self):
+        """Claim the next job to run, return its index in `names`, or None if
+        none is left.
+        """
+        with self._manifest() as jobs:
+            for i, name in enumerate(self.names):
+                job = jobs[name]
+                if (job['status'] == 'pending'
+                        or job['status'] == 'failed'
+                        and job['tries'] < self.max_tries
+                        or job['status'] == 'running' and self._stale(job)):
+                    job.update(status='running', owner=self.owner,
+                               time=time.time())
+                    job['tries'] += 1
+                    return i
+        return None
+
+    def complete(self, i, paths):
+        """Mark the `i`-th job done, with the checksums of its output `paths`.
+        """
+        checksums = {p: checksum(p) for p in paths}
+        with self._manifest() as jobs:
+            jobs[self.names[i]].update(status='done', owner=self.owner,
+                                       time=time.time(), checksums=checksums)
+
+    def fail(self, i, error):
+        with self._manifest() as jobs:
+            jobs[self.names[i]].update(status='failed', owner=self.owner,
+                                       time=time.time(), error=str(error))
+
+    def verify(self):
+        """Reset the done jobs whose outputs are missing or modified.
+
+        Return the names of the jobs reset.
+        """
+        with self._manifest() as jobs:
+            reset = []
+            for name in self.names:
+                job = jobs[name]
+                if job['status'] != 'done':
+                    continue
+                if any(not os.path.isfile(p) or checksum(p) != c
+                       for p, c in job.get('checksums', {}).items()):
+                    job.update(status='pending', tries=0)
+                    reset.append(name)
+            return reset
+
+    def summary(self):
+        with self._manifest() as jobs:
+            counts = {}
+            for name in self.names:
+                status = jobs[name]['status']
+                counts[status] = counts.get(status, 0) + 1
+            return counts
+
+    def _stale(self, job):
+        if self.timeout is not None and time.time() - job['time'] > self.timeout:
+            return True
+
+        host, pid = job['owner'].rsplit(':', 1)
+        if host != socket.gethostname():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    @contextmanager
+    def _manifest(self):
+        """Lock, load, and yield the jobs in the manifest, and save them
+        atomically on exit.
+        """
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path, 'r') as f:
+                        jobs = json.load(f)
+                except FileNotFoundError:
+                    jobs = {}
+
+                yield jobs
+
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(jobs, f, indent=1)
+                os.replace(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def checksum(path, chunk_size=1 << 24):
+    """SHA-256 hex digest of a file.
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
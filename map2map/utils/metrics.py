@@ -0,0 +1,251 @@
+import os
+import csv
+import json
+import time
+import threading
+import warnings
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import torch
+
+
+class MetricsWriter:
+    """Buffered metrics writer, flushing scalars in batches from a background
+    thread.
+
+    Scalars can be tensors, whose host transfers (syncs) are deferred to the
+    background thread, and thus do not stall the training loop.
+    A scalar can be lazily reduced by passing the async work handle (`work`)
+    of the collective (e.g. `dist.all_reduce(..., async_op=True)`), and an
+    optional `scale` (e.g. `1 / world_size`), both resolved in the background.
+
+    `backends` is a comma-sep. string or list of backend names among
+    'tensorboard', 'jsonl', 'csv', and 'http', see `BACKENDS`.
+    The scalars are flushed every `flush_secs` seconds, or earlier when more
+    than `max_queue` are buffered.
+
+    Unlike `SummaryWriter.add_scalars`, `add_scalars` writes each entry as a
+    regular scalar under `main_tag/tag`, without an extra event file per tag.
+    Figures are passed through synchronously to the backends supporting them.
+    """
+    def __init__(self, backends='tensorboard', log_dir=None, flush_secs=10,
+                 max_queue=1000, http_port=0):
+        if isinstance(backends, str):
+            backends = backends.split(',')
+
+        if log_dir is None:
+            log_dir = os.path.join('runs', time.strftime('%b%d_%H-%M-%S'))
+
+        self.backends = []
+        for name in backends:
+            if name not in BACKENDS:
+                raise ValueError('metrics backend {} not supported'.format(name))
+            self.backends.append(
+                BACKENDS[name](log_dir=log_dir, http_port=http_port))
+
+        self.flush_secs = flush_secs
+        self.max_queue = max_queue
+
+        self._buffer = []
+        self._buffer_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._flush_event = threading.Event()
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add_scalar(self, tag, scalar_value, global_step=None, walltime=None,
+                   work=None, scale=None):
+        if isinstance(scalar_value, torch.Tensor):
+            scalar_value = scalar_value.detach()
+        if walltime is None:
+            walltime = time.time()
+
+        with self._buffer_lock:
+            self._buffer.append(
+                (tag, scalar_value, global_step, walltime, work, scale))
+            queued = len(self._buffer)
+
+        if queued >= self.max_queue:
+            self._flush_event.set()
+
+    def add_scalars(self, main_tag, tag_scalar_dict, global_step=None,
+                    walltime=None, **kwargs):
+        for tag, scalar_value in tag_scalar_dict.items():
+            self.add_scalar(main_tag + '/' + tag, scalar_value,
+                            global_step=global_step, walltime=walltime,
+                            **kwargs)
+
+    def add_figure(self, tag, figure, global_step=None, **kwargs):
+        with self._write_lock:
+            for backend in self.backends:
+                if hasattr(backend, 'add_figure'):
+                    backend.add_figure(tag, figure, global_step=global_step,
+                                       **kwargs)
+
+    def flush(self):
+        """Request a flush by the background thread without waiting for it.
+        """
+        self._flush_event.set()
+
+    def close(self):
+        """Flush all the buffered scalars and close the backends.
+        """
+        self._closed = True
+        self._flush_event.set()
+        self._thread.join()
+
+        self._write()
+
+        for backend in self.backends:
+            backend.close()
+
+    def _run(self):
+        while not self._closed:
+            self._flush_event.wait(self.flush_secs)
+            self._flush_event.clear()
+
+            self._write()
+
+    def _write(self):
+        with self._write_lock:
+            with self._buffer_lock:
+                records, self._buffer = self._buffer, []
+
+            if len(records) == 0:
+                return
+
+            scalars = []
+            for tag, value, step, walltime, work, scale in records:
+                # drop the bad records, e.g. of a failed collective, instead
+                # of killing the thread
+                try:
+                    if work is not None:
+                        work.wait()
+                    if isinstance(value, torch.Tensor):
+                        value = value.item()
+                    if scale is not None:
+                        value *= scale
+                    value = float(value)
+                except Exception as e:
+                    warnings.warn('metrics record {} at step {} dropped: {}'
+                                  .format(tag, step, e))
+                    continue
+                scalars.append((tag, value, step, walltime))
+
+            for backend in self.backends:
+                try:
+                    backend.write(scalars)
+                except Exception as e:
+                    warnings.warn('metrics backend {} failed: {}'.format(
+                        type(backend).__name__, e))
+
+
+class TensorBoardBackend:
+    def __init__(self, log_dir=None, **kwargs):
+        from torch.utils.tensorboard import SummaryWriter
+
+        self.writer = SummaryWriter(log_dir=log_dir)
+
+    def write(self, scalars):
+        for tag, value, step, walltime in scalars:
+            self.writer.add_scalar(tag, value, global_step=step,
+                                   walltime=walltime)
+        self.writer.flush()
+
+    def add_figure(self, tag, figure, global_step=None, **kwargs):
+        self.writer.add_figure(tag, figure, global_step=global_step, **kwargs)
+
+    def close(self):
+        self.writer.close()
+
+
+class JSONLBackend:
+    """One JSON object per scalar per line in `log_dir/metrics.jsonl`.
+    """
+    def __init__(self, log_dir, **kwargs):
+        os.makedirs(log_dir, exist_ok=True)
+        self.file = open(os.path.join(log_dir, 'metrics.jsonl'), 'a')
+
+    def write(self, scalars):
+        for tag, value, step, walltime in scalars:
+            self.file.write(json.dumps({'tag': tag, 'value': value,
+                                        'step': step, 'time': walltime}))
+            self.file.write('\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CSVBackend:
+    """Rows of tag, value, step, and time in `log_dir/metrics.csv`.
+    """
+    def __init__(self, log_dir, **kwargs):
+        os.makedirs(log_dir, exist_ok=True)
+        path = os.path.join(log_dir, 'metrics.csv')
+        is_new = not os.path.isfile(path)
+
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if is_new:
+            self.writer.writerow(['tag', 'value', 'step', 'time'])
+
+    def write(self, scalars):
+        self.writer.writerows(scalars)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class HTTPBackend:
+    """Serve the latest value of every scalar as JSON on localhost.
+
+    A stub exporter to be polled by a local dashboard or scraper, e.g.
+    `curl localhost:<port>/metrics`, with the port printed on start.
+    Port 0 picks a free one.
+    """
+    def __init__(self, http_port=0, **kwargs):
+        self.latest = {}
+        self.lock = threading.Lock()
+
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with backend.lock:
+                    body = json.dumps(backend.latest).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', http_port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        print('metrics served at http://127.0.0.1:{}/metrics'.format(
+            self.server.server_address[1]), flush=True)
+
+    def write(self, scalars):
+        with self.lock:
+            for tag, value, step, walltime in scalars:
+                self.latest[tag] = {'value': value, 'step': step,
+                                    'time': walltime}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+BACKENDS = {
+    'tensorboard': TensorBoardBackend,
+    'jsonl': JSONLBackend,
+    'csv': CSVBackend,
+    'http': HTTPBackend,
+}
@@ -0,0 +1,135 @@
+import os
+import csv
+import numpy as np
+import torch
+
+from ..models import power, lag2eul
+
+
+class SnapshotMetrics:
+    """Per-snapshot test metrics, accumulated on device over the patches to
+    avoid host syncs, and written as one table at the end.
+
+    For each of the `nfile` snapshots: the MSE of every channel, the ratio of
+    the output to target power spectra of every field (split by `chan`), and
+    optionally (`eul`) the statistics of the Eulerian densities from the
+    first 3 channels as displacements, by `lag2eul`.
+    The power spectra are those of the patches, averaged over them, with
+    wavenumbers in unit of the fundamental frequency of the patches.
+    """
+    def __init__(self, nfile, chan, device, eul=False):
+        self.chan = chan
+        self.eul = eul
+
+        C = sum(chan)
+        self.crops = torch.zeros(nfile, dtype=torch.int64, device=device)
+        self.sse = torch.zeros(nfile, C, dtype=torch.float64, device=device)
+        self.count = torch.zeros(nfile, dtype=torch.float64, device=device)
+
+        self.k = None
+        self.P_out = self.P_tgt = None
+
+        if eul:
+            # sums of output, output^2, target, target^2, and squared error
+            self.eul_sums = torch.zeros(nfile, 5, dtype=torch.float64,
+                                        device=device)
+            self.eul_count = torch.zeros(nfile, dtype=torch.float64,
+                                         device=device)
+
+    def update(self, ifile, output, target, style=None):
+        """Accumulate a batch of patches of snapshots `ifile`, a sequence of
+        ints, with `style` (on host) needed by `lag2eul`.
+        """
+        output, target = output.detach(), target.detach()
+        device = output.device
+        N = len(output)
+
+        # consecutive samples of the same snapshot, usually the whole batch
+        ifile = list(ifile)
+        bounds = np.flatnonzero(np.diff(ifile)) + 1
+        groups = [(ifile[start], start, stop)
+                  for start, stop in zip([0, *bounds], [*bounds, N])]
+
+        ifile = torch.tensor(ifile, device=device)
+        self.crops.index_add_(0, ifile, torch.ones_like(ifile))
+
+        err = (output - target).square().flatten(start_dim=2)
+        self.sse.index_add_(0, ifile, err.sum(dim=2).double())
+        self.count.index_add_(0, ifile, torch.full(
+            (N,), err.shape[2], dtype=torch.float64, device=device))
+
+        for i, start, stop in groups:
+            self._update_snapshot(i, output[start:stop], target[start:stop],
+                                  None if style is None else style[start])
+
+    def _update_snapshot(self, ifile, output, target, style):
+        n = len(output)
+
+        for i, (start, stop) in enumerate(zip(np.cumsum([0] + self.chan[:-1]),
+                                              np.cumsum(self.chan))):
+            k, P_out, _ = power(output[:, start:stop])
+            _, P_tgt, _ = power(target[:, start:stop])
+
+            if self.k is None:
+                self.k = k
+                shape = len(self.crops), len(self.chan), len(k)
+                self.P_out = torch.zeros(shape, dtype=torch.float64,
+                                         device=k.device)
+                self.P_tgt = torch.zeros_like(self.P_out)
+
+            self.P_out[ifile, i] += n * P_out
+            self.P_tgt[ifile, i] += n * P_tgt
+
+        if self.eul:
+            kwargs = {}
+            if style is not None and style.numel() > 0:
+                kwargs['a'] = float(style)
+            eul_out, eul_tgt = lag2eul([output[:, :3], target[:, :3]],
+                                       **kwargs)
+            self.eul_sums[ifile] += torch.stack([
+                eul_out.sum(), eul_out.square().sum(),
+                eul_tgt.sum(), eul_tgt.square().sum(),
+                (eul_out - eul_tgt).square().sum(),
+            ]).double()
+            self.eul_count[ifile] += eul_out.numel()
+
+    def write(self, path, names=None):
+        """Write a CSV table of a row per snapshot assembled, named by
+        `names`, and return the rows.
+        """
+        crops = self.crops.cpu().numpy()
+        mse = (self.sse / self.count[:, None]).cpu().numpy()
+
+        header = ['snapshot', 'crops']
+        header += ['mse_{}'.format(c) for c in range(sum(self.chan))]
+        if self.k is not None:
+            k = self.k.cpu().numpy()
+            ratio = (self.P_out / self.P_tgt).cpu().numpy()
+            header += ['power_ratio_{}_k{:.3g}'.format(i, kk)
+                       for i in range(len(self.chan)) for kk in k]
+        if self.eul:
+            sums = (self.eul_sums / self.eul_count[:, None]).cpu().numpy()
+            header += ['eul_mean_out', 'eul_std_out', 'eul_mean_tgt',
+                       'eul_std_tgt', 'eul_mse']
+
+        rows = []
+        for ifile in np.flatnonzero(crops):
+            row = [ifile if names is None else names[ifile], crops[ifile]]
+            row += mse[ifile].tolist()
+            if self.k is not None:
+                row += ratio[ifile].flatten().tolist()
+            if self.eul:
+                m_out, m2_out, m_tgt, m2_tgt, sqe = sums[ifile]
+                row += [m_out, np.sqrt(max(m2_out - m_out ** 2, 0)),
+                        m_tgt, np.sqrt(max(m2_tgt - m_tgt ** 2, 0)), sqe]
+            rows.append(row)
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+        return rows
@@ -0,0 +1,88 @@
+import math
+import numpy as np
+
+from ..models.shape import probe, shape_info
+
+
+def plan_tiling(model, size, scale_factor, mem_budget, in_chan, style_size=0,
+                batch_size=1):
+    """Plan an overlap-save tiling of the fields of `size` (of the input
+    resolution) for inference by `model`, under `mem_budget` bytes.
+
+    The narrowing is introspected by `shape_info` and `probe`, with the
+    output size and the size of every convolution output affine in the
+    input size.
+    The least pad letting the output cover the crop then follows, and each
+    tile only overlaps its neighbors by that halo.
+    Among the crops evenly tiling the fields, pick the one with the least
+    redundant halo compute, whose peak memory estimate (the largest input
+    plus output of a layer) fits in the budget.
+
+    Return the dict of the chosen crop, pad, step, out_size (of the tiles),
+    mem, and redundancy, the ratio of the halo compute to that of the crop,
+    and the list of all candidates as 'candidates'.
+    """
+    size = np.broadcast_to(size, (3,))
+
+    n0, n1 = int(size.min()), 2 * int(size.min())
+    info = shape_info(model, n0, in_chan, style_size=style_size)
+    if not math.isclose(info['scale'], scale_factor):
+        raise RuntimeError('model upsamples by {}, not by scale factor {}'
+                           .format(info['scale'], scale_factor))
+    pad = info['pad']
+
+    # affine fit of the conv sizes with 2 probes
+    _, convs0, _ = probe(model, in_chan, n0, style_size=style_size)
+    _, convs1, _ = probe(model, in_chan, n1, style_size=style_size)
+    conv_slopes = [(c1[2] - c0[2]) / (n1 - n0)
+                   for c0, c1 in zip(convs0, convs1)]
+
+    candidates = []
+    for crop in range(1, int(size.min()) + 1):
+        if any(size % crop != 0):
+            continue
+
+        try:
+            out_size, convs, activations = probe(
+                model, in_chan, crop + 2 * pad, style_size=style_size,
+                batch_size=batch_size)
+        except (RuntimeError, ValueError):  # e.g. too small, or not divisible
+            continue
+        if out_size < crop * scale_factor:
+            continue
+
+        macs = sum(m * s ** 3 for _, m, s in convs)
+        macs_crop = sum(m * (k * crop) ** 3
+                        for (_, m, _), k in zip(convs, conv_slopes))
+
+        candidates.append({
+            'crop': crop,
+            'pad': pad,
+            'step': crop,
+            'out_size': out_size,
+            'mem': max(activations),
+            'redundancy': macs / macs_crop - 1,
+        })
+
+    fits = [c for c in candidates if c['mem'] <= mem_budget]
+    if len(fits) == 0:
+        raise RuntimeError('no tiling fits in the memory budget of {} bytes'
+                           .format(mem_budget))
+
+    plan = min(fits, key=lambda c: c['redundancy'])
+    plan = dict(plan, candidates=candidates)
+
+    return plan
+
+
+def format_tiling(plan):
+    """Format the tiling candidates of `plan_tiling` as a table, with the
+    chosen one marked.
+    """
+    lines = ['{:>6} {:>5} {:>6} {:>10} {:>11}'.format(
+        'crop', 'pad', 'tile', 'mem [GiB]', 'redundancy')]
+    for c in plan['candidates']:
+        lines.append('{:>6} {:>5} {:>6} {:>10.4g} {:>11.1%}{}'.format(
+            c['crop'], c['pad'], c['crop'] + 2 * c['pad'], c['mem'] / 2**30,
+            c['redundancy'], ' *' if c['crop'] == plan['crop'] else ''))
+    return '\n'.join(lines)
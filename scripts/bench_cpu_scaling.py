@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""Benchmark the scaling efficiency of CPU training over gloo on this node.
+
+Example:
+
+    python bench_cpu_scaling.py --model styled_srsgan.G --in-chan 6 \\
+        --out-chan 6 --style-size 1 --size 18 --scale-factor 2 --procs 1,2,4 \\
+        --misc-kwargs '{"chan_base": 64, "chan_max": 64}'
+"""
+import argparse
+import json
+
+from map2map.args import int_tuple
+from map2map.utils.dist import bench_scaling, format_scaling
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--model', type=str, required=True,
+            help='model in map2map.models')
+    parser.add_argument('--in-chan', type=int, required=True)
+    parser.add_argument('--out-chan', type=int, required=True)
+    parser.add_argument('--style-size', default=0, type=int)
+    parser.add_argument('--size', default=32, type=int,
+            help='input size including padding')
+    parser.add_argument('--batch-size', default=1, type=int,
+            help='per process')
+    parser.add_argument('--scale-factor', default=1, type=int)
+    parser.add_argument('--procs', default='1,2,4', type=int_tuple,
+            help='comma-sep. list of numbers of processes')
+    parser.add_argument('--loader-workers', default=0, type=int,
+            help='data loader workers to reserve CPUs for')
+    parser.add_argument('--channels-last', action='store_true')
+    parser.add_argument('--steps', default=10, type=int)
+    parser.add_argument('--misc-kwargs', default='{}', type=json.loads)
+    args = parser.parse_args()
+
+    procs = args.procs if isinstance(args.procs, tuple) else (args.procs,)
+
+    results = bench_scaling(
+        args.model, args.in_chan, args.out_chan,
+        style_size=args.style_size,
+        size=args.size,
+        batch_size=args.batch_size,
+        scale_factor=args.scale_factor,
+        procs=procs,
+        loader_workers=args.loader_workers,
+        channels_last=args.channels_last,
+        steps=args.steps,
+        **args.misc_kwargs,
+    )
+    print(format_scaling(results))